@@ -1,18 +1,28 @@
 import os
+import re
+import time
 import base64
+import hashlib
+import inspect
 import functools
-from datetime import datetime
-from types import CoroutineType
+from datetime import datetime, timezone
+from email.utils import format_datetime
 from urllib.parse import quote
 
 import isbnlib
-from sanic import Sanic, HTTPResponse, html, file, redirect
+from sanic import Sanic, HTTPResponse, html, redirect
 
+import db
+import jobs
+import assets
+import metrics
 import objects as O
-from db import conn
+from templates import Template
 
 
 PAGE_SIZE = 50
+# streamed pages are sent in pieces of about this many characters
+CHUNK_SIZE = 4096
 app = Sanic("ook2")
 CORRECT_AUTH = os.environ["OOK_CREDS"]
 
@@ -20,6 +30,94 @@ def D(multival_dict):
     return {key: val[0] for key, val in multival_dict.items()}
 
 
+request_duration = metrics.Histogram(
+    "ook_http_request_duration_seconds",
+    "Time from receiving a request until the last of its response was sent",
+    ("method", "route"),
+)
+responses = metrics.Counter(
+    "ook_http_responses_total", "Responses by status", ("method", "route", "status"),
+)
+sql_statements = metrics.Counter(
+    "ook_sql_statements_total", "SQL statements run while handling requests", ("route",),
+)
+sql_seconds = metrics.Counter(
+    "ook_sql_seconds_total",
+    "Time spent running SQL statements and reading their results while handling requests",
+    ("route",),
+)
+sql_rows = metrics.Counter(
+    "ook_sql_rows_total", "Rows read or changed while handling requests", ("route",),
+)
+
+
+def cache_metric(key):
+    return lambda: {(name,): stats[key] for name, stats in O.cache_stats().items()}
+
+
+metrics.Gauge("ook_cache_entries", "Entries in a cache", ("cache",), cache_metric("size"))
+metrics.Gauge("ook_cache_max_entries", "Size limit of a cache", ("cache",), cache_metric("maxsize"))
+metrics.Gauge("ook_cache_hit_ratio", "Share of lookups a cache could answer", ("cache",), cache_metric("hit_rate"))
+metrics.Counter("ook_cache_hits_total", "Lookups a cache could answer", ("cache",), cache_metric("hits"))
+metrics.Counter("ook_cache_misses_total", "Lookups a cache couldn't answer", ("cache",), cache_metric("misses"))
+metrics.Counter("ook_cache_evictions_total", "Entries dropped to make room", ("cache",), cache_metric("evictions"))
+
+
+def record_request(request, status):
+    route = request.uri_template or "unmatched"
+    request_duration.observe(
+        time.perf_counter() - request.ctx.started, method=request.method, route=route,
+    )
+    responses.inc(method=request.method, route=route, status=status)
+    if (stats := getattr(request.ctx, "sql", None)) is not None:
+        sql_statements.inc(stats.statements, route=route)
+        sql_seconds.inc(stats.seconds, route=route)
+        sql_rows.inc(stats.rows, route=route)
+
+
+if metrics.ENABLED:
+    @app.on_request
+    async def start_timer(request):
+        request.ctx.started = time.perf_counter()
+
+    @app.on_response
+    async def record_response(request, response):
+        # streamed pages are recorded once their last chunk was sent
+        if not getattr(request.ctx, "streaming", False):
+            record_request(request, response.status)
+
+    @app.after_server_start
+    async def watch_event_loop(app):
+        metrics.watch_event_loop()
+
+    @app.get("/metrics")
+    async def metrics_page(request):
+        return HTTPResponse(
+            metrics.render(),
+            headers={"Cache-Control": "no-store"},
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
+if db.SQL_STATS or metrics.ENABLED:
+    @app.on_request
+    async def start_sql_stats(request):
+        request.ctx.sql = db.collect_stats()
+
+
+if db.SQL_STATS:
+    @app.on_response
+    async def server_timing(request, response):
+        # streamed pages send their headers early, so for them this only
+        # covers the statements run before the rendering
+        if (stats := getattr(request.ctx, "sql", None)) is None:
+            return
+        response.headers["Server-Timing"] = (
+            f'sql;dur={stats.seconds * 1000:.2f};'
+            f'desc="{stats.statements} statements, {stats.rows} rows"'
+        )
+
+
 @app.on_request
 async def read_cookies(request):
     cookie = request.cookies.get("ook_auth")
@@ -33,6 +131,11 @@ async def read_cookies(request):
         request.ctx.prefers_shelf = False
 
 
+@app.exception(O.InvalidCursor)
+async def invalid_cursor(request, exception):
+    return HTTPResponse(body="400 Bad Request", status=400)
+
+
 def authenticated(route):
     @functools.wraps(route)
     async def wrapper(request, *args, **kwargs):
@@ -75,55 +178,89 @@ async def logout(request):
     return response
 
 
-def pagination(url, page_no, *, more_results=True):
-    if not more_results and page_no == 1:
+def pagination(url, *, prev=None, next=None):
+    if prev is None and next is None:
         return ""
     q = "&" if "?" in url else "?"
     return f"""<br>
         <a
             role="button"
             class="prev"
-            href="{url}{q}page={page_no - 1}"
-            {"disabled" if page_no == 1 else ""}
+            href="{url}{q}{prev or ""}"
+            {"disabled" if prev is None else ""}
         >&lt;</a>
         <a
             class="next"
             role="button"
-            href="{url}{q}page={page_no + 1}"
-            {"disabled" if not more_results else ""}
+            href="{url}{q}{next or ""}"
+            {"disabled" if next is None else ""}
         >&gt;</a>
     """
 
 
-def infinite(url, page_no, direction):
+def infinite(url, cursor, direction):
     q = "&" if "?" in url else "?"
     if direction == "forward":
-        page_no += 1
+        query = f"after={cursor}"
         text = "➡\ufe0e"
     else:
-        page_no -= 1
+        query = f"before={cursor}"
         text = "⬅\ufe0e"
     return f"""
         <span
         class="nextprev clickable"
-        hx-get="{url}{q}page={page_no}&direction={direction}"
+        hx-get="{url}{q}{query}&direction={direction}"
         hx-select=".bookshelf>*"
-        hx-push-url="{url}{q}page={page_no}"
+        hx-push-url="{url}{q}{query}"
         hx-swap="outerHTML"
         >{text}</span>
     """
 
 
+ASSETS = assets.load({
+    "htmx.js": "text/javascript",
+    "style.css": "text/css",
+    "pico.min.css": "text/css",
+    "logo.svg": "image/svg+xml",
+})
+ASSET_URLS = {asset.url: asset for asset in ASSETS.values()}
+
 with open("template.html") as f:
-    TEMPLATE = f.read().format
+    source = f.read()
+    # link the assets by their fingerprinted URLs, which can be cached forever
+    for path, asset in ASSETS.items():
+        source = source.replace(f'"/{path}"', f'"{asset.url}"')
+    TEMPLATE = Template(source, "page")
+    HEAD, TAIL = TEMPLATE.split("main")
+
+# pages only change along with the data, or with the code rendering them
+RELEASE = hashlib.md5(b"".join(
+    open(name, "rb").read()
+    for name in ("api.py", "objects.py", "templates.py", "template.html")
+) + source.encode()).hexdigest()[:8]
+
+
+async def invalidate_caches(request):
+    # only requests that use the models catch up on the changes of other
+    # workers; assets and metrics are served without touching the database
+    if not getattr(request.ctx, "caches_synced", False):
+        request.ctx.caches_synced = True
+        await db.run(O.sync_caches)
+
+
+async def call(fn, *args, **kwargs):
+    # handlers that aren't coroutines use the database (or might, through
+    # lazy fields), so they run in the database's thread pool
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args, **kwargs)
+    return await db.run(fn, *args, **kwargs)
 
 
 def fragment(fn):
     @functools.wraps(fn)
-    async def wrapper(*args, **kwargs):
-        ret = fn(*args, **kwargs)
-        if isinstance(ret, CoroutineType):
-            ret = await ret
+    async def wrapper(request, *args, **kwargs):
+        await invalidate_caches(request)
+        ret = await call(fn, request, *args, **kwargs)
         return html(ret)
     return wrapper
 
@@ -131,9 +268,8 @@ def fragment(fn):
 def page(fn):
     @functools.wraps(fn)
     async def wrapper(request, *args, **kwargs):
-        ret = fn(request, *args, **kwargs)
-        if isinstance(ret, CoroutineType):
-            ret = await ret
+        await invalidate_caches(request)
+        ret = await call(fn, request, *args, **kwargs)
         if request.ctx.authenticated:
             login_button = """<a
                 class="login"
@@ -151,10 +287,78 @@ def page(fn):
             title = "Ook!"
         if not isinstance(ret, dict):
             ret = {"main": ret, "shelf": ""}
-        return html(TEMPLATE(**ret, login=login_button, title=title))
+        headers = getattr(request.ctx, "validators", None)
+        if not isinstance(ret["main"], str):
+            return await send_streaming(
+                request, ret["main"], headers, login=login_button, title=title,
+            )
+        return html(TEMPLATE(**ret, login=login_button, title=title), headers=headers)
     return wrapper
 
 
+def conditional(fn):
+    """Answer conditional GETs of pages with 304 while the data is unchanged"""
+    @functools.wraps(fn)
+    async def wrapper(request, *args, **kwargs):
+        await invalidate_caches(request)
+        change_id, changed_at = O.data_version()
+        variant = (
+            ("a" if request.ctx.authenticated else "p")
+            + ("s" if request.ctx.prefers_shelf else "t")
+        )
+        etag = f'W/"{RELEASE}-{change_id}-{variant}"'
+        validators = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+        if changed_at:
+            validators["Last-Modified"] = format_datetime(
+                datetime.fromisoformat(changed_at).replace(tzinfo=timezone.utc),
+                usegmt=True,
+            )
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return HTTPResponse(status=304, headers=validators)
+        request.ctx.validators = validators
+        return await fn(request, *args, **kwargs)
+    return wrapper
+
+
+def stream(*parts):
+    """Chain strings and iterables of strings, for streamed pages"""
+    for part in parts:
+        if isinstance(part, str):
+            yield part
+        else:
+            yield from part
+
+
+def next_chunk(parts):
+    chunk, size = [], 0
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= CHUNK_SIZE:
+            break
+    return "".join(chunk)
+
+
+async def send_streaming(request, parts, headers=None, **values):
+    # the handler has already read the rows; they are rendered in the
+    # thread pool, as that may load missing fields
+    request.ctx.streaming = True
+    response = await request.respond(
+        headers=headers, content_type="text/html; charset=utf-8",
+    )
+    try:
+        await response.send(HEAD(**values))
+        while chunk := await db.run(next_chunk, parts):
+            await response.send(chunk)
+        await response.send(TAIL(**values))
+    finally:
+        # stops the row generators if the client went away
+        await db.run(parts.close)
+        if metrics.ENABLED:
+            record_request(request, response.status)
+    await response.eof()
+
+
 @app.get("/login")
 @page
 async def login_form(request):
@@ -168,9 +372,10 @@ async def login_form(request):
 
 
 @app.get("/")
+@conditional
 @page
-async def index(request):
-    lent_out = list(O.Book.all_lent_out())
+def index(request):
+    lent_out = list(O.Book.all_lent_out(fields=O.Book.projections["table-row"]))
     return f"""<article>
     <h4>Hello!</h4>
     <p>Here you can find most of the physical books we have at home. They are
@@ -188,32 +393,18 @@ async def index(request):
 
 
 @app.get("/authors")
+@conditional
 @page
-async def list_authors(request):
-    page_no = int(request.args.get("page", 1))
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            authors, COUNT(1) AS count
-        FROM books
-        GROUP BY authors
-        ORDER BY sort_key
-        LIMIT ?
-        OFFSET ?
-        """,
-        ((PAGE_SIZE + 1), (page_no - 1) * (PAGE_SIZE + 1))
+def list_authors(request):
+    authors, prev_cursor, next_cursor = O.Author.page(
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        size=PAGE_SIZE,
     )
     rows = []
-    more_results = False
-    for i, row in enumerate(cur.fetchall()):
-        if i == PAGE_SIZE:
-            more_results = True
-            break
-        if not row[0].strip():
-            continue
+    for author in authors:
         rows.append(f"""
-            <tr><td><a href="/books?author={quote(row["authors"])}">{row["authors"]}</a></td><td>{row["count"]}</td></tr>
+            <tr><td>{author}</td><td>{author.book_count}</td></tr>
         """)
     return "Authors", f"""
         <table class="striped">
@@ -225,15 +416,16 @@ async def list_authors(request):
         </tbody></table>
         {pagination(
             "/authors",
-            page_no,
-            more_results=more_results,
+            prev=prev_cursor and f"before={prev_cursor}",
+            next=next_cursor and f"after={next_cursor}",
         )}
     """
 
 
 @app.get("/collections")
+@conditional
 @page
-async def list_collections(request):
+def list_collections(request):
     return "Collections", "<br>".join(
         str(collection) for collection in O.Collection.all(order_by="name COLLATE NOCASE ASC")
     ) + ("""<button
@@ -261,7 +453,7 @@ async def new_collection_form(request):
 @app.post("/collections/new")
 @authenticated
 @fragment
-async def new_collection(request):
+def new_collection(request):
     form = D(request.form)
     name = form["name"]
     collection = O.Collection.new(name)
@@ -276,50 +468,37 @@ async def new_collection(request):
     """
 
 
-def build_shelf(
-    books,
-    *,
-    base_url=None,
-    page_size=PAGE_SIZE,
-    page_no=1,
-    direction,
-):
+def iter_shelf(page, *, base_url=None, direction):
     if direction is None:
         extensions = ("back", "forward")
     else:
         extensions = (direction,)
-    parts = ["""<div class="bookshelf">"""]
-    more_results = False
+    yield """<div class="bookshelf">"""
     last_letter = None
-    books = list(books)
-    if len(books) > page_size:
-        more_results = True
-        books.pop()
-    else:
-        more_results = False
-    if "back" in extensions and page_no > 1:
-        parts.append(infinite(base_url, page_no, "back"))
-    for i, book in enumerate(books):
-        did_index = False
+    for i, book in enumerate(page):
+        # the page only knows whether there is a previous one once its first
+        # book was read
+        if not i and "back" in extensions and page.prev_cursor:
+            yield infinite(base_url, page.prev_cursor, "back")
         letter = book.index_letter
         if letter != last_letter and i:
-            parts.append(f"""<span class="nobreak"><div class="index"><span>{letter}</span></div>""")
-            did_index = True
+            yield f"""<span class="nobreak"><div class="index"><span>{letter}</span></div>{book.render("spine")}</span>"""
+        else:
+            yield book.render("spine")
         last_letter = letter
-        book = f"{book:spine}"
-        parts.append(book)
-        if did_index:
-            parts.append("</span>")
-    if "forward" in extensions and more_results:
-        parts.append(infinite(base_url, page_no, "forward"))
-    parts.append("</div>")
-    parts.append("""
+    if "forward" in extensions and page.next_cursor:
+        yield infinite(base_url, page.next_cursor, "forward")
+    yield """</div>
         <script>
         var s = document.getElementsByClassName("bookshelf")[0];
         s.addEventListener("wheel", function(e){s.scrollBy({top: 0, left: -e.wheelDeltaY*3, behavior: 'smooth'});})
         </script>
-    """)
-    return "".join(parts)
+    """
+
+
+def projection(request):
+    # what iter_shelf() or iter_table() will show of each book
+    return O.Book.projections["spine" if request.ctx.prefers_shelf else "table-row"]
 
 
 def build_isbn_input(collection_id):
@@ -334,37 +513,39 @@ def build_isbn_input(collection_id):
     >"""
 
 
-def build_table(
+def iter_table(
     books,
     *,
     base_url=None,
-    page_size=PAGE_SIZE,
-    page_no=1,
+    prev=None,
+    next=None,
 ):
-    rows = []
-    more_results = False
-    for i, book in enumerate(books):
-        if i == page_size:
-            more_results = True
-        else:
-            rows.append(f"{book:table-row:title,authors,location}")
-
-    return f"""
+    yield """
         <table class="striped">
         <thead>
         <tr><th>Book</th><th>Authors</th><th>Location</th></tr>
         </thead>
         <tbody>
-        {"".join(rows)}
+    """
+    for book in books:
+        yield book.render("table-row:title,authors,location")
+    if isinstance(books, O.KeysetPage):
+        prev = books.prev_cursor and f"before={books.prev_cursor}"
+        next = books.next_cursor and f"after={books.next_cursor}"
+    yield f"""
         </tbody></table>
         {pagination(
             base_url,
-            page_no,
-            more_results=more_results,
+            prev=prev,
+            next=next,
         ) if base_url else ''}
     """
 
 
+def build_table(books, **kwargs):
+    return "".join(iter_table(books, **kwargs))
+
+
 def view_toggle_for(url, *, state=False):
     return f"""<label class="view-toggle"><input
         type="checkbox"
@@ -398,52 +579,117 @@ async def set_view_pref(request):
 def add_book_button(collection_id):
     return f"""
         <button class="add-book-button" hx-get="/collections/{collection_id}/isbn-input" hx-swap="outerHTML">+</button>
+        <button class="add-book-button secondary" hx-get="/collections/{collection_id}/bulk-form" hx-swap="outerHTML">+++</button>
     """
 
 
+def build_job_progress(job):
+    finished = job["imported"] + job["not_found"] + job["failed"]
+    rejected = f", {job['rejected']} ignored" if job["rejected"] else ""
+    if finished == job["total"]:
+        return f"""<div class="job">
+            Imported {job["imported"]} of {job["total"]} books
+            ({job["not_found"]} not found, {job["failed"]} failed{rejected}).
+        </div>"""
+    return f"""<div
+        class="job"
+        hx-get="/jobs/{job["id"]}"
+        hx-trigger="every 1s"
+        hx-swap="outerHTML"
+    >
+        <progress value="{finished}" max="{job["total"]}"></progress>
+        Looked up {finished} of {job["total"]} books…
+    </div>"""
+
+
 @app.get("/collections/<collection_id>/isbn-input")
 @fragment
 async def isbn_input(request, collection_id: int):
     return build_isbn_input(collection_id)
 
 
+@app.get("/collections/<collection_id>/bulk-form")
+@fragment
+async def bulk_form(request, collection_id: int):
+    return f"""
+        <form
+            hx-post="/collections/{collection_id}/bulk-add"
+            hx-swap="outerHTML"
+            hx-encoding="multipart/form-data"
+        >
+            <textarea name="isbns" placeholder="ISBNs, one per line"></textarea>
+            <input type="file" name="file" accept=".csv,.txt">
+            <button type="submit">»</button>
+        </form>
+    """
+
+
+@app.post("/collections/<collection_id>/bulk-add")
+@authenticated
+@fragment
+async def bulk_add_books(request, collection_id: int):
+    text = D(request.form).get("isbns", "")
+    if upload := request.files.get("file"):
+        text += "\n" + upload.body.decode("utf-8", "replace")
+    isbns, rejected = [], []
+    for token in re.split(r"[\s,;\"']+", text):
+        if not token:
+            continue
+        if isbn := isbnlib.to_isbn13(isbnlib.canonical(token)):
+            isbns.append(isbn)
+        else:
+            rejected.append(token)
+    books = await db.run(O.Book.new_placeholders, isbns, collection_id=collection_id)
+    job_id = await jobs.enqueue(books, rejected)
+    return build_job_progress(await db.run(jobs.get_import, job_id))
+
+
+@app.get("/jobs/<job_id>")
+@fragment
+async def job_progress(request, job_id: int):
+    if (job := await db.run(jobs.get_import, job_id)) is None:
+        return ""
+    return build_job_progress(job)
+
+
 @app.get("/collections/<collection_id>")
+@conditional
 @page
-async def view_collection(request, collection_id: int):
-    page_no = int(request.args.get("page", 1))
+def view_collection(request, collection_id: int):
     direction = request.args.get("direction")
     collection = O.Collection(collection_id)
-    books = O.Book.all(
+    books = O.Book.stream_page(
         collection_id=collection_id,
-        offset=PAGE_SIZE * (page_no - 1),
-        limit=PAGE_SIZE + 1,  # so we know if there would be more results
-        order_by="sort_key ASC",
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        size=PAGE_SIZE,
+        fields=projection(request),
     )
 
-    return collection.name, f"""
+    return collection.name, stream(
+        f"""
         {add_book_button(collection_id) if request.ctx.authenticated else ""}
         {collection:heading}
         {view_toggle_for(
             f"/collections/{collection_id}",
             state=request.ctx.prefers_shelf,
         )}
-        {build_shelf(
+        """,
+        iter_shelf(
             books,
             base_url=f"/collections/{collection_id}",
-            page_no=page_no,
             direction=direction,
-        ) if request.ctx.prefers_shelf else build_table(
+        ) if request.ctx.prefers_shelf else iter_table(
             books,
             base_url=f"/collections/{collection_id}",
-            page_no=page_no,
-        )}
-    """
+        ),
+    )
 
 
 @app.post("/books/<book_id>/rename")
 @authenticated
 @fragment
-async def rename_book(request, book_id: int):
+def rename_book(request, book_id: int):
     book = O.Book(book_id)
     title = D(request.form)["title"]
     if title:
@@ -454,7 +700,7 @@ async def rename_book(request, book_id: int):
 @app.post("/books/<book_id>/lend")
 @authenticated
 @fragment
-async def lend_book(request, book_id: int):
+def lend_book(request, book_id: int):
     book = O.Book(book_id)
     lender = request.headers["HX-Prompt"].encode("ascii", "surrogateescape").decode("latin-1")
     if lender:
@@ -468,7 +714,7 @@ async def lend_book(request, book_id: int):
 @app.post("/books/<book_id>/return")
 @authenticated
 @fragment
-async def return_book(request, book_id: int):
+def return_book(request, book_id: int):
     book = O.Book(book_id)
     book.return_()
     return f"""<meta
@@ -482,7 +728,7 @@ async def return_book(request, book_id: int):
 @fragment
 async def fetch_book(request, book_id: int):
     book = O.Book(book_id)
-    book.import_metadata()
+    await book.import_metadata()
     return f"""<meta
         http-equiv="refresh"
         content="0; url=/books/{book_id}"
@@ -492,7 +738,7 @@ async def fetch_book(request, book_id: int):
 @app.delete("/books/<book_id>")
 @authenticated
 @fragment
-async def delete_book(request, book_id: int):
+def delete_book(request, book_id: int):
     book = O.Book(book_id)
     collection_id = book.collection.id
     book.delete()
@@ -505,7 +751,7 @@ async def delete_book(request, book_id: int):
 @app.post("/collections/<collection_id>/rename")
 @authenticated
 @fragment
-async def rename_collection(request, collection_id: int):
+def rename_collection(request, collection_id: int):
     collection = O.Collection(collection_id)
     name = D(request.form)["name"]
     if name:
@@ -521,7 +767,7 @@ async def add_book_by_isbn(request, collection_id: int):
     isbn = D(request.form)["isbn"]
     display = "shelf" if request.ctx.prefers_shelf else "table"
     try:
-        book = O.Book.new_from_isbn(isbn, collection_id=collection_id)
+        book = await O.Book.new_from_isbn(isbn, collection_id=collection_id)
     except isbnlib.NotValidISBNError:
         return f"""
             {build_isbn_input(collection_id)}
@@ -549,7 +795,7 @@ async def add_book_by_isbn(request, collection_id: int):
 @app.put("/books/<book_id>")
 @authenticated
 @fragment
-async def put_book_data(request, book_id: int):
+def put_book_data(request, book_id: int):
     data = D(request.form)
     book = O.Book(book_id)
     book.title = data["title"]
@@ -563,8 +809,9 @@ async def put_book_data(request, book_id: int):
 
 
 @app.get("/books/<book_id>")
+@conditional
 @page
-async def view_book(request, book_id: int):
+def view_book(request, book_id: int):
     book = O.Book(book_id)
     return book.title, f"""
         <article>
@@ -582,7 +829,7 @@ async def view_book(request, book_id: int):
 
 @app.get("/books/<book_id>/authors-form")
 @fragment
-async def edit_authors_form(request, book_id: int):
+def edit_authors_form(request, book_id: int):
     book = O.Book(book_id)
     return f"""<td><input
         hx-post="/books/{book_id}/authors"
@@ -597,90 +844,144 @@ async def edit_authors_form(request, book_id: int):
 @app.post("/books/<book_id>/authors")
 @authenticated
 @fragment
-async def change_authors(request, book_id: int):
+def change_authors(request, book_id: int):
     book = O.Book(book_id)
     form = D(request.form)
     if authors := form["authors"]:
         book.authors = authors
-        book.sort_key = book.calculate_sort_key()
         book.save()
     return f"{book:authors-editable}"
 
 
 @app.get("/books")
+@conditional
 @page
-async def list_books(request):
-    page_no = int(request.args.get("page", 1))
+def list_books(request):
     author = request.args.get("author")
     direction = request.args.get("direction")
-    books = O.Book.all(
-        offset=PAGE_SIZE * (page_no - 1),
-        limit=PAGE_SIZE + 1,  # so we know if there would be more results
-        order_by="sort_key ASC",
-        author=author
+    books = O.Book.stream_page(
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        size=PAGE_SIZE,
+        author=author,
+        fields=projection(request),
     )
     if author:
         title = f"All books of {author}"
+        base_url = f"/books?author={quote(author)}"
     else:
         title = "All books"
-    return title, f"""
-        {view_toggle_for(
+        base_url = "/books"
+    return title, stream(
+        view_toggle_for(
             f"/books",
             state=request.ctx.prefers_shelf,
-        )}
-        {build_shelf(
+        ),
+        iter_shelf(
             books,
-            base_url="/books",
-            page_no=page_no,
+            base_url=base_url,
             direction=direction,
-        ) if request.ctx.prefers_shelf else build_table(
+        ) if request.ctx.prefers_shelf else iter_table(
             books,
-            base_url="/books",
-            page_no=page_no,
-        )}
-    """
+            base_url=base_url,
+        ),
+    )
 
 
 @app.get("/books/search")
+@conditional
 @page
-async def search_books(request):
+def search_books(request):
     page_no = int(request.args.get("page", 1))
     query = D(request.args).get("q", "")
-    books = O.Book.search(
+    books = list(O.Book.search(
         q=query,
         page_no=page_no - 1,
         page_size=PAGE_SIZE + 1,  # so we know if there would be more results
-    )
+        fields=O.Book.projections["table-row"],
+    ))
     return build_table(
-        books,
-        base_url=f"/books/search?q={query}",
-        page_no=page_no,
+        books[:PAGE_SIZE],
+        base_url=f"/books/search?q={quote(query)}",
+        prev=f"page={page_no - 1}" if page_no > 1 else None,
+        next=f"page={page_no + 1}" if len(books) > PAGE_SIZE else None,
     )
 
 
+@app.after_server_start
+async def resume_recalculations(app):
+    # pick up where a recalculation interrupted by a restart left off
+    for recalculation_id in await db.run(jobs.unfinished_recalculations):
+        jobs.ensure_recalculation(recalculation_id)
+
+
+def build_recalculation_progress(state):
+    if state["finished_at"]:
+        return f"""<span class="job">Recalculated {state["done"]} sort keys</span>"""
+    return f"""<span
+        class="job"
+        hx-get="/settings/recalculate/{state["id"]}"
+        hx-trigger="every 1s"
+        hx-swap="outerHTML"
+    >
+        <progress value="{state["done"]}" max="{state["total"]}"></progress>
+    </span>"""
+
+
 @app.post("/settings/recalculate")
 @authenticated
 @fragment
 async def recalculate_sort_keys(request):
-    O.Book.recalculate_all_sort_keys()
-    return "Ok"
+    recalculation_id = await db.run(jobs.start_recalculation)
+    jobs.ensure_recalculation(recalculation_id)
+    return build_recalculation_progress(
+        await db.run(jobs.get_recalculation, recalculation_id),
+    )
+
+
+@app.get("/settings/recalculate/<recalculation_id>")
+@fragment
+async def recalculation_progress(request, recalculation_id: int):
+    if (state := await db.run(jobs.get_recalculation, recalculation_id)) is None:
+        return ""
+    return build_recalculation_progress(state)
+
+
+def send_asset(request, asset, cache_control):
+    encoding, body = asset.negotiate(request.headers.get("accept-encoding", ""))
+    etag = asset.etags[encoding]
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return HTTPResponse(status=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return HTTPResponse(body, headers=headers, content_type=asset.mime_type)
+
+
+@app.get("/static/<filename>")
+async def static_asset(request, filename):
+    if (asset := ASSET_URLS.get(f"/static/{filename}")) is None:
+        return HTTPResponse(body="404 Not Found", status=404)
+    return send_asset(request, asset, "public, max-age=31536000, immutable")
 
 
+# the plain URLs keep working for links from elsewhere, but have to be
+# revalidated
 @app.get("/htmx.js")
 async def htmx_js(request):
-    return await file("htmx.js", mime_type="text/javascript")
+    return send_asset(request, ASSETS["htmx.js"], "no-cache")
 
 
 @app.get("/style.css")
 async def style_css(request):
-    return await file("style.css", mime_type="text/css")
+    return send_asset(request, ASSETS["style.css"], "no-cache")
 
 
 @app.get("/pico.min.css")
 async def pico_css(request):
-    return await file("pico.min.css", mime_type="text/css")
+    return send_asset(request, ASSETS["pico.min.css"], "no-cache")
 
 
 @app.get("/logo.svg")
 async def logo_svg(request):
-    return await file("logo.svg", mime_type="image/svg+xml")
+    return send_asset(request, ASSETS["logo.svg"], "no-cache")
@@ -0,0 +1,57 @@
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Asset:
+    """A static file, read and compressed once, under a content-hashed URL"""
+
+    def __init__(self, path, mime_type):
+        with open(path, "rb") as f:
+            body = f.read()
+        self.path = path
+        self.mime_type = mime_type
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        name, extension = os.path.splitext(os.path.basename(path))
+        self.url = f"/static/{name}.{self.digest}{extension}"
+        self.bodies = {"identity": body}
+        compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli:
+            compressed["br"] = brotli.compress(body)
+        for encoding, data in compressed.items():
+            # SVGs and the like can be too small to be worth it
+            if len(data) < len(body):
+                self.bodies[encoding] = data
+        # each encoding is a different representation, so caches must not
+        # mix them up under one strong validator
+        self.etags = {
+            encoding: f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+            for encoding in self.bodies
+        }
+
+    def negotiate(self, accept_encoding):
+        """The best encoding the client accepts, and the body in it"""
+        accepted = set()
+        for part in accept_encoding.split(","):
+            encoding, _, params = part.partition(";")
+            name, _, value = params.partition("=")
+            try:
+                if name.strip() == "q" and float(value) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(encoding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
+
+
+def load(files):
+    """Read `{path: mime_type}` into Assets by path"""
+    return {path: Asset(path, mime_type) for path, mime_type in files.items()}
@@ -0,0 +1,188 @@
+"""Generate a synthetic library for benchmarking.
+
+    python bench/generate.py 100k [path]
+
+Sizes can be given as 1k, 100k, 1m or plain numbers. The database is created
+through the migrations in db.py, so it always has the current schema. A few
+authors write most of the books and a few collections hold most of them, like
+in a real library.
+"""
+import os
+import sys
+import random
+import sqlite3
+import itertools
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIRST_NAMES = [
+    "Anna", "Ben", "Clara", "David", "Emil", "Frida", "Georg", "Hanna", "Ivo",
+    "Jana", "Karl", "Lena", "Marko", "Nina", "Oskar", "Petra", "Sanja",
+    "Tomáš", "Ursula", "Zoë", "Ðorđe", "Élise", "Jürgen", "Søren", "Ana María",
+]
+LAST_NAMES = [
+    "Müller", "Smith", "Šehić", "Novak", "García", "Jansen", "Kowalski",
+    "Rossi", "Dubois", "Andersson", "Horvat", "O'Brien", "van der Berg",
+    "Nakamura", "Petrović", "Schulz", "Ng", "Lindqvist", "Costa", "Weiß",
+]
+WORDS = [
+    "night", "river", "empire", "garden", "silence", "journey", "stone",
+    "winter", "letters", "shadow", "house", "glass", "mountain", "island",
+    "history", "memory", "city", "war", "light", "sea", "time", "forest",
+]
+COLLECTION_NAMES = [
+    "Living room", "Bedroom", "Office", "Attic", "Basement", "Hallway",
+    "Kids' room", "Kitchen", "Guest room", "Storage",
+]
+CHUNK = 10000
+
+
+def parse_size(text):
+    text = text.lower()
+    for suffix, factor in (("k", 1000), ("m", 1000000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def default_path(size):
+    return os.path.join(tempfile.gettempdir(), f"ook-bench-{size}.db")
+
+
+def copy(path):
+    """Copy a library into a new temporary directory, WAL included"""
+    target = os.path.join(tempfile.mkdtemp(), "ook2.db")
+    source, destination = sqlite3.connect(path), sqlite3.connect(target)
+    try:
+        source.backup(destination)
+    finally:
+        source.close()
+        destination.close()
+    return target
+
+
+def isbn13(number):
+    digits = f"978{number:09d}"
+    check = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10) % 10
+    return f"{digits}{check}"
+
+
+def author_name(i):
+    # unique for the first 26 * 20 * 21 * 25 numbers
+    first = FIRST_NAMES[i % len(FIRST_NAMES)]
+    i //= len(FIRST_NAMES)
+    initial = chr(ord("A") + i % 26)
+    i //= 26
+    last = LAST_NAMES[i % len(LAST_NAMES)]
+    i //= len(LAST_NAMES)
+    if i:
+        last = f"{LAST_NAMES[(i - 1) % len(LAST_NAMES)]}-{last}"
+    return f"{first} {initial}. {last}"
+
+
+def zipf_cum_weights(n, s=0.8):
+    weights = itertools.accumulate(1 / (rank ** s) for rank in range(1, n + 1))
+    return list(weights)
+
+
+def generate(size, path, seed=0):
+    if os.path.exists(path):
+        os.remove(path)
+    os.environ["OOK_DB"] = path
+    import db
+    from names import author_sort_key
+
+    rng = random.Random(seed)
+    n_authors = min(max(10, size // 4), 26 * 20 * 21 * 25)
+    n_collections = max(3, min(200, size // 500))
+    authors = [author_name(i) for i in range(n_authors)]
+    # so that the prolific authors are spread over the alphabet
+    rng.shuffle(authors)
+    author_weights = zipf_cum_weights(n_authors)
+    collection_weights = zipf_cum_weights(n_collections)
+
+    with db.transaction() as cur:
+        cur.executemany(
+            "INSERT INTO collections (id, name) VALUES (?, ?)",
+            (
+                (i, f"{COLLECTION_NAMES[i % len(COLLECTION_NAMES)]} {i // len(COLLECTION_NAMES) + 1}")
+                for i in range(1, n_collections + 1)
+            ),
+        )
+        cur.executemany(
+            "INSERT INTO authors (id, name, sort_key) VALUES (?, ?, ?)",
+            ((i, name, author_sort_key(name)) for i, name in enumerate(authors, 1)),
+        )
+
+    for start in range(1, size + 1, CHUNK):
+        ids = range(start, min(start + CHUNK, size + 1))
+        books, links = [], []
+        for book_id in ids:
+            # about one in a hundred books was never imported
+            imported = rng.random() > 0.01
+            books.append((
+                book_id,
+                " ".join(rng.choices(WORDS, k=rng.randint(1, 5))).capitalize() if imported else None,
+                rng.choice(["Penguin", "Suhrkamp", "Vintage", "Fischer", None]) if imported else None,
+                rng.randint(1900, 2025) if imported else None,
+                isbn13(book_id),
+                rng.choices(range(1, n_collections + 1), cum_weights=collection_weights)[0],
+                rng.choice(["Alice", "Bob", "Carol"]) if rng.random() < 0.02 else None,
+            ))
+            if imported:
+                count = rng.choices((1, 2, 3), (70, 25, 5))[0]
+                chosen = list(dict.fromkeys(rng.choices(range(1, n_authors + 1), cum_weights=author_weights, k=count)))
+                links.extend((author_id, book_id, position) for position, author_id in enumerate(chosen))
+        with db.transaction() as cur:
+            cur.executemany(
+                """
+                INSERT INTO books
+                    (id, title, publisher, year, isbn, collection_id, borrowed_to, sort_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, '')
+                """,
+                books,
+            )
+            # the triggers fill in the books' sort keys and the authors' counts
+            cur.executemany(
+                "INSERT INTO book_authors (author_id, book_id, position) VALUES (?, ?, ?)",
+                links,
+            )
+            cur.execute(
+                """
+                UPDATE books
+                SET authors = (
+                    SELECT group_concat(name, ', ')
+                    FROM (
+                        SELECT authors.name
+                        FROM book_authors
+                        JOIN authors ON authors.id = book_authors.author_id
+                        WHERE book_authors.book_id = books.id
+                        ORDER BY book_authors.position
+                    )
+                )
+                WHERE id BETWEEN ? AND ?
+                """,
+                (ids[0], ids[-1]),
+            )
+        print(f"Generated {ids[-1]}/{size} books", file=sys.stderr)
+    with db.transaction() as cur:
+        # the change log isn't needed for a fresh library
+        cur.execute("DELETE FROM changes")
+    db.conn.execute("VACUUM")
+    db.conn.execute("ANALYZE")
+    # so that the library is all in the main file, which is what gets copied
+    db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return path
+
+
+def main():
+    size = parse_size(sys.argv[1] if len(sys.argv) > 1 else "1k")
+    path = sys.argv[2] if len(sys.argv) > 2 else default_path(size)
+    generate(size, path)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Measure how much memory books take up in the identity map.
+
+    python bench/memory.py 100k
+
+Loads every book of a synthetic library (generated with bench/generate.py
+if needed) into Book._cache, once with all fields and once with what the
+shelf shows, and reports the bytes per book that are still allocated
+afterwards. The fragment cache is left empty.
+"""
+import os
+import sys
+import gc
+import tracemalloc
+import subprocess
+
+import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def setup(size):
+    path = generate.default_path(size)
+    if not os.path.exists(path):
+        subprocess.run(
+            [sys.executable, os.path.join(HERE, "generate.py"), str(size), path],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    copy = generate.copy(path)
+    os.environ.update({
+        "OOK_DB": copy,
+        "OOK_CACHE_SIZE": str(size + 1000),
+        "OOK_CACHE_TTL": "3600",
+        "OOK_METRICS": "0",
+    })
+    os.chdir(generate.ROOT)
+    import objects
+    return objects
+
+
+def measure(O, size, fields):
+    O.Book._cache.clear()
+    O.Collection._cache.clear()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for book in O.Book.iter_all(limit=size, fields=fields):
+        pass
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(O.Book._cache)
+
+
+def main():
+    size = generate.parse_size(sys.argv[1] if len(sys.argv) > 1 else "10k")
+    O = setup(size)
+    for name, fields in (("all fields", None), ("spine", O.Book.projections["spine"])):
+        print(f"{name:12} {measure(O, size, fields):8.0f} bytes per book")
+
+
+if __name__ == "__main__":
+    main()
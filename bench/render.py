@@ -0,0 +1,77 @@
+"""Microbenchmark for rendering shelves and tables of 50 books.
+
+Run from anywhere with `python bench/render.py [rounds]`; it uses a throwaway
+database, so the real library is never touched.
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["OOK_DB"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ.setdefault("OOK_CREDS", "bench")
+
+import api
+import objects as O
+
+BOOKS = 50
+
+
+def make_books():
+    return [
+        O.Book.from_row({
+            "id": i,
+            "title": f"The Book of Things, Volume {i}",
+            "authors": "Jane Doe, Faruk Šehić" if i % 3 else "John Smith",
+            "publisher": "Publisher",
+            "year": 1990 + i % 30,
+            "isbn": f"978316148{i:04d}",
+            "created_at": None,
+            "imported_at": None,
+            "borrowed_to": "Bob" if i % 10 == 0 else None,
+            "sort_key": f"{chr(65 + i // 4)} SORT KEY {i}",
+            "version": 0,
+            "collection_id": 1,
+            "collection_name": "Living room",
+        })
+        for i in range(1, BOOKS + 1)
+    ]
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    books = make_books()
+    shelf = lambda: "".join(api.iter_shelf(
+        O.KeysetPage(
+            books + books[:1],
+            key=lambda book: (book.sort_key, book.id),
+            after="p",
+            size=BOOKS,
+        ),
+        base_url="/books",
+        direction=None,
+    ))
+    table = lambda: api.build_table(books, base_url="/books", prev="p", next="n")
+
+    def uncached(render):
+        def case():
+            O.fragments.clear()
+            return render()
+        return case
+
+    cases = {
+        "shelf": uncached(shelf),
+        "shelf, cached": shelf,
+        "table": uncached(table),
+        "table, cached": table,
+    }
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=rounds, repeat=10)) / rounds
+        print(f"{name:14} {best * 1e6:8.1f} µs per page  {best * 1e6 / BOOKS:6.2f} µs per row")
+    print("fragment cache:", O.fragments.stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Benchmark the app in-process against a synthetic library.
+
+    python bench/run.py 100k --save baseline.json
+    python bench/run.py 100k --compare baseline.json
+
+The library is generated with bench/generate.py the first time and reused
+afterwards; each run works on a copy of it. Requests go straight to the
+app's ASGI interface, and ISBN lookups are answered by the stub provider from
+metadata.py, so nothing but the app itself is measured. Comparing against a
+saved baseline exits with 1 if any scenario got slower by more than the
+tolerance, or issues more queries per request than before.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlencode, quote
+
+import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def setup(size):
+    """Prepare a copy of the library and the environment, then import the app"""
+    path = generate.default_path(size)
+    if not os.path.exists(path):
+        subprocess.run(
+            [sys.executable, os.path.join(HERE, "generate.py"), str(size), path],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    copy = generate.copy(path)
+    port = free_port()
+    os.environ.update({
+        "OOK_DB": copy,
+        "OOK_CREDS": "bench",
+        "OOK_ISBN_PROVIDERS": "stub",
+        "OOK_ISBN_STUB_URL": f"http://localhost:{port}",
+        "OOK_ISBN_RATE_LIMIT": "0",
+    })
+    os.chdir(generate.ROOT)
+    import metadata
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(("localhost", port), metadata.StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    import api
+    return api.app
+
+
+class Client:
+    """Just enough of an ASGI server to send requests to the app"""
+
+    def __init__(self, app):
+        self.app = app
+        self.shutdown = None
+
+    async def start(self):
+        started = asyncio.Event()
+        self.shutdown = asyncio.Event()
+        messages = iter([{"type": "lifespan.startup"}])
+
+        async def receive():
+            try:
+                return next(messages)
+            except StopIteration:
+                await self.shutdown.wait()
+                return {"type": "lifespan.shutdown"}
+
+        async def send(message):
+            if message["type"] == "lifespan.startup.complete":
+                started.set()
+            elif message["type"] == "lifespan.startup.failed":
+                raise RuntimeError(message.get("message"))
+
+        self.lifespan = asyncio.create_task(self.app({"type": "lifespan"}, receive, send))
+        await started.wait()
+
+    async def stop(self):
+        self.shutdown.set()
+        await self.lifespan
+
+    async def request(self, method, url, *, form=None, headers=None):
+        path, _, query = url.partition("?")
+        body = urlencode(form).encode() if form else b""
+        headers = {
+            "host": "localhost",
+            "cookie": "ook_auth=bench",
+            **({"content-type": "application/x-www-form-urlencoded"} if form else {}),
+            **(headers or {}),
+        }
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(k.encode(), v.encode("utf-8")) for k, v in headers.items()],
+            "client": ("127.0.0.1", 0),
+            "server": ("localhost", 80),
+        }
+        requested = False
+        status = None
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        await self.app(scope, receive, send)
+        return status
+
+
+def scenarios(size):
+    """(name, method, url or function returning one, keyword arguments)"""
+    import db
+    import objects as O
+    with db.reading() as cur:
+        middle = cur.execute(
+            "SELECT sort_key, id FROM books ORDER BY sort_key, id LIMIT 1 OFFSET ?",
+            (size // 2,),
+        ).fetchone()
+        collection_id = cur.execute(
+            "SELECT collection_id FROM books GROUP BY 1 ORDER BY count(*) DESC LIMIT 1"
+        ).fetchone()[0]
+        author = cur.execute(
+            "SELECT name FROM authors ORDER BY book_count DESC LIMIT 1"
+        ).fetchone()[0]
+    cursor = O.encode_cursor(tuple(middle))
+    rng = random.Random(0)
+    isbns = (generate.isbn13(number) for number in range(size + 1, 10 ** 9))
+    random_book = lambda: rng.randint(1, size)
+    table = {"cookie": "ook_auth=bench; prefers_shelf="}
+    return [
+        ("index", "GET", "/", {}),
+        ("books", "GET", "/books", {}),
+        ("books (table)", "GET", "/books", {"headers": table}),
+        ("books, middle", "GET", f"/books?after={cursor}", {}),
+        ("collection", "GET", f"/collections/{collection_id}", {}),
+        ("author", "GET", f"/books?author={quote(author)}", {}),
+        ("authors", "GET", "/authors", {}),
+        ("search", "GET", "/books/search?q=river", {}),
+        ("book", "GET", lambda: f"/books/{random_book()}", {}),
+        ("add book", "POST", f"/collections/{collection_id}/add-book",
+            {"form": lambda: {"isbn": next(isbns)}}),
+        ("lend", "POST", lambda: f"/books/{random_book()}/lend",
+            {"headers": {"HX-Prompt": "Bench"}}),
+        ("return", "POST", lambda: f"/books/{random_book()}/return", {}),
+        ("rename", "POST", lambda: f"/books/{random_book()}/rename",
+            {"form": lambda: {"title": f"Renamed {rng.random()}"}}),
+    ]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def measure(client, method, url, kwargs, *, requests, concurrency, warmup):
+    import db
+    queries = 0
+    last = None
+
+    def count(statement):
+        nonlocal queries, last
+        # the search index's own statements show up as comments, and each
+        # statement run by a trigger as the statement that fired it again
+        if not statement.startswith("--") and statement != last:
+            queries += 1
+        last = statement
+
+    async def one():
+        kw = {key: value() if callable(value) else value for key, value in kwargs.items()}
+        start = time.perf_counter()
+        status = await client.request(method, url() if callable(url) else url, **kw)
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors.append(status)
+
+    async def worker(n):
+        for _ in range(n):
+            await one()
+
+    latencies, errors = [], []
+    for _ in range(warmup):
+        await one()
+    latencies, errors = [], []
+    db.set_trace_callback(count)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        worker(requests // concurrency + (i < requests % concurrency))
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+    db.set_trace_callback(None)
+    return {
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / elapsed,
+        "queries": queries / len(latencies),
+        "errors": len(errors),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print()
+    print(f"{'':16} {'p50 before':>10} {'p50 now':>10} {'change':>8} {'queries':>12}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        slower = change > tolerance
+        more_queries = result["queries"] > before["queries"] + 0.01
+        if slower or more_queries:
+            regressions.append(name)
+        print(
+            f"{name:16} {before['p50_ms']:10.2f} {result['p50_ms']:10.2f} {change:+8.0%}"
+            f" {before['queries']:5.1f} → {result['queries']:<5.1f}"
+            f"{'  REGRESSION' if slower or more_queries else ''}"
+        )
+    return regressions
+
+
+async def run(args):
+    app = setup(args.size)
+    client = Client(app)
+    await client.start()
+    results = {}
+    print(f"{'':16} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}")
+    try:
+        for name, method, url, kwargs in scenarios(args.size):
+            if args.only and not any(part in name for part in args.only):
+                continue
+            result = results[name] = await measure(
+                client, method, url, kwargs,
+                requests=args.requests,
+                concurrency=args.concurrency,
+                warmup=args.warmup,
+            )
+            print(
+                f"{name:16} {result['p50_ms']:8.2f} {result['p99_ms']:8.2f}"
+                f" {result['rps']:8.1f} {result['queries']:8.1f}"
+                f"{'  (' + str(result['errors']) + ' errors)' if result['errors'] else ''}"
+            )
+    finally:
+        await client.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n")[0])
+    parser.add_argument("size", nargs="?", default="1k", type=generate.parse_size)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--only", action="append", help="only run matching scenarios")
+    parser.add_argument("--save", help="store the results as a baseline")
+    parser.add_argument("--compare", help="compare with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"size": args.size, "concurrency": args.concurrency, "results": results},
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline["size"], baseline["concurrency"]) != (args.size, args.concurrency):
+            print(
+                f"Warning: the baseline was measured with {baseline['size']} books"
+                f" and {baseline['concurrency']} concurrent requests"
+            )
+        if regressions := compare(results, baseline["results"], args.tolerance):
+            print("Regressions:", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A size-bounded mapping that forgets the least recently used entries.
+
+    Entries can optionally expire after `ttl` seconds. With `maxweight`, the
+    sum of `weigh(value)` over the entries is bounded as well.
+    """
+
+    def __init__(self, maxsize, *, ttl=None, maxweight=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                self.evictions += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def setdefault(self, key, value):
+        # like get() followed by a set, but without anybody sneaking in between
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.monotonic()):
+                return entry[0]
+            self._set(key, value)
+            return value
+
+    def _set(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (value, expires_at)
+        if self.weigh:
+            self.weight += self.weigh(value)
+        while len(self._data) > self.maxsize or (
+            self.maxweight is not None and self.weight > self.maxweight
+        ):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        if self.weigh:
+            self.weight -= self.weigh(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def remove_if(self, predicate):
+        """Drop the entries whose key matches"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight if self.weigh else None,
+            "maxweight": self.maxweight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+        }
@@ -1,8 +1,295 @@
+import os
 import sys
+import time
+import queue
+import asyncio
 import sqlite3
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-conn = sqlite3.connect("ook2.db")
-conn.row_factory = sqlite3.Row
+import metrics
+from names import split_authors, author_sort_key
+
+DB_PATH = os.environ.get("OOK_DB", "ook2.db")
+READERS = int(os.environ.get("OOK_DB_READERS", 4))
+# with WAL, NORMAL can lose the last transactions on power loss, but never
+# corrupts the database; FULL fsyncs on every commit
+SYNCHRONOUS = os.environ.get("OOK_DB_SYNCHRONOUS", "NORMAL")
+# writes arriving within this many milliseconds of each other share a commit
+GROUP_COMMIT_MS = float(os.environ.get("OOK_DB_GROUP_COMMIT_MS", 2))
+# statements taking longer than this many milliseconds are logged along with
+# their query plan; setting it (or OOK_SQL_STATS=1) also collects statistics
+# per request and sends them in a Server-Timing header. Without either, and
+# with metrics turned off, cursors are plain sqlite3 cursors.
+SLOW_QUERY_MS = float(os.environ.get("OOK_SLOW_QUERY_MS", 0))
+SQL_STATS = os.environ.get("OOK_SQL_STATS") == "1" or SLOW_QUERY_MS > 0
+
+connections = []
+_trace = None
+
+
+class SQLStats:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0
+        self.rows = 0
+
+
+# the statistics of the request being handled, if any; run() carries them
+# over into the thread pool
+sql_stats = contextvars.ContextVar("sql_stats", default=None)
+
+
+def collect_stats():
+    stats = SQLStats()
+    sql_stats.set(stats)
+    return stats
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Times statements, including reading their results, and counts rows"""
+
+    statement = None
+    seconds = 0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self.statement = (sql, parameters)
+        self.seconds = 0
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(time.perf_counter() - start, max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self.statement = (sql, ())
+        self.seconds = 0
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(time.perf_counter() - start, max(self.rowcount, 0))
+            self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - start, row is not None, statements=0)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(time.perf_counter() - start, len(rows), statements=0)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - start, len(rows), statements=0)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record(time.perf_counter() - start, 0, statements=0)
+            self._finish()
+            raise
+        self._record(time.perf_counter() - start, 1, statements=0)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def _record(self, seconds, rows, *, statements=1):
+        self.seconds += seconds
+        if (stats := sql_stats.get()) is not None:
+            stats.statements += statements
+            stats.seconds += seconds
+            stats.rows += rows
+
+    def _finish(self):
+        # called once all of a statement's results were read (or abandoned)
+        if self.statement is None:
+            return
+        sql, parameters = self.statement
+        self.statement = None
+        if SLOW_QUERY_MS and self.seconds * 1000 > SLOW_QUERY_MS:
+            log_slow_query(self.connection, sql, parameters, self.seconds)
+
+
+def log_slow_query(conn, sql, parameters, seconds):
+    print(f"Slow query ({seconds * 1000:.1f} ms): {' '.join(sql.split())}")
+    try:
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters):
+            print("   ", row["detail"])
+    except sqlite3.Error:
+        pass
+
+
+CURSOR = InstrumentedCursor if SQL_STATS or metrics.ENABLED else sqlite3.Cursor
+
+
+def unicode_upper(text):
+    return None if text is None else text.upper()
+
+
+def connect(*, readonly=False):
+    # connections are handed between threads, but never used by two at once
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # SQLite's own UPPER() only knows ASCII
+    conn.create_function("unicode_upper", 1, unicode_upper, deterministic=True)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    conn.set_trace_callback(_trace)
+    connections.append(conn)
+    return conn
+
+
+def set_trace_callback(callback):
+    global _trace
+    _trace = callback
+    for conn in connections:
+        conn.set_trace_callback(callback)
+
+
+# the one connection that writes (and runs the migrations below)
+conn = connect()
+conn.execute("PRAGMA journal_mode = WAL")
+conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+write_lock = threading.RLock()
+_depth = threading.local()
+_batch = None
+
+_readers = queue.Queue()
+_readers_lock = threading.Lock()
+_reader_count = 0
+
+executor = ThreadPoolExecutor(READERS, thread_name_prefix="db")
+
+
+@contextmanager
+def reading():
+    """Borrow a read-only connection from the pool and yield a cursor on it."""
+    global _reader_count
+    try:
+        reader = _readers.get_nowait()
+    except queue.Empty:
+        with _readers_lock:
+            new = _reader_count < READERS
+            _reader_count += new
+        reader = connect(readonly=True) if new else _readers.get()
+    cur = reader.cursor(CURSOR)
+    try:
+        yield cur
+    finally:
+        cur.close()
+        _readers.put(reader)
+
+
+class _Batch:
+    def __init__(self):
+        self.committed = threading.Event()
+        self.error = None
+
+
+@contextmanager
+def transaction():
+    """Run the statements of the with-block as one unit of work on the writer.
+
+    Either all of them take effect or (if the block raises) none. Units of
+    work that arrive within GROUP_COMMIT_MS are committed together, and the
+    with-statement only returns once its unit is committed. Nested units of
+    work become part of the outer one.
+    """
+    global _batch
+    error = None
+    with write_lock:
+        nested = getattr(_depth, "value", 0) > 0
+        began = not nested and not conn.in_transaction
+        if began:
+            conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor(CURSOR)
+        try:
+            cur.execute("SAVEPOINT unit_of_work")
+        except BaseException:
+            if began:
+                conn.rollback()
+            raise
+        # only join (or start) a batch once the unit of work could begin:
+        # a batch nobody commits would leave all later writers waiting
+        if not nested:
+            if _batch is None:
+                _batch = _Batch()
+                leader = True
+            else:
+                leader = False
+            batch = _batch
+        _depth.value = getattr(_depth, "value", 0) + 1
+        try:
+            yield cur
+        except BaseException as e:
+            error = e
+        finally:
+            _depth.value -= 1
+            try:
+                if not conn.in_transaction:
+                    raise sqlite3.OperationalError("transaction was rolled back")
+                if error:
+                    cur.execute("ROLLBACK TO unit_of_work")
+                cur.execute("RELEASE unit_of_work")
+            except sqlite3.Error as e:
+                # SQLite rolls back the whole transaction by itself on a full
+                # disk, an I/O error and the like, and with it the other units
+                # of work of the batch: they all fail, and later writers start
+                # a new one
+                if conn.in_transaction:
+                    conn.rollback()
+                error = error or e
+                if _batch is not None:
+                    _batch.error = _batch.error or e
+                    _batch = None
+    if not nested:
+        if leader:
+            # give other writers a moment to join this batch, then commit it
+            time.sleep(GROUP_COMMIT_MS / 1000)
+            with write_lock:
+                if _batch is batch:
+                    _batch = None
+                try:
+                    conn.commit()
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    batch.error = e
+            batch.committed.set()
+        else:
+            batch.committed.wait()
+        if batch.error and not error:
+            error = batch.error
+    if error:
+        raise error
+
+
+async def run(fn, *args, **kwargs):
+    """Call a function that uses the database without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    # in the caller's context, so that the statements count for its request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, fn, *args, **kwargs),
+    )
 
 
 try:
@@ -79,3 +366,319 @@ def rename_place_id_to_collection_id(cur):
 @migration(3)
 def add_sort_key(cur):
     cur.execute("""ALTER TABLE books ADD sort_key TEXT""")
+
+@migration(4)
+def add_change_log(cur):
+    # every write to a cached table is logged here, so that other processes
+    # know which of their cached objects are stale
+    cur.execute("""
+        CREATE TABLE changes
+        (
+            id INTEGER PRIMARY KEY,
+            table_name TEXT,
+            row_id INTEGER,
+            changed_at TIMESTAMP DEFAULT (datetime('now'))
+        )
+    """)
+    for table in ("books", "collections"):
+        for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            cur.execute(f"""
+                CREATE TRIGGER log_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO changes (table_name, row_id) VALUES ('{table}', {ref}.id);
+                END
+            """)
+    cur.execute("""
+        CREATE TRIGGER prune_changes
+        AFTER INSERT ON changes
+        BEGIN
+            DELETE FROM changes WHERE id <= NEW.id - 10000;
+        END
+    """)
+
+@migration(5)
+def add_search_index(cur):
+    cur.execute("""
+        CREATE VIRTUAL TABLE books_fts USING fts5
+        (
+            title,
+            authors,
+            publisher,
+            isbn,
+            content='books',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    # matches in the title count more than in the authors, which count more
+    # than anything else
+    cur.execute("""
+        INSERT INTO books_fts (books_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0, 1.0)')
+    """)
+    cur.execute("""
+        CREATE TRIGGER books_fts_insert
+        AFTER INSERT ON books
+        BEGIN
+            INSERT INTO books_fts (rowid, title, authors, publisher, isbn)
+            VALUES (NEW.id, NEW.title, NEW.authors, NEW.publisher, NEW.isbn);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER books_fts_delete
+        AFTER DELETE ON books
+        BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', OLD.id, OLD.title, OLD.authors, OLD.publisher, OLD.isbn);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER books_fts_update
+        AFTER UPDATE OF title, authors, publisher, isbn ON books
+        BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', OLD.id, OLD.title, OLD.authors, OLD.publisher, OLD.isbn);
+            INSERT INTO books_fts (rowid, title, authors, publisher, isbn)
+            VALUES (NEW.id, NEW.title, NEW.authors, NEW.publisher, NEW.isbn);
+        END
+    """)
+    cur.execute("""
+        INSERT INTO books_fts (books_fts) VALUES ('rebuild')
+    """)
+
+@migration(6)
+def default_sort_key(cur):
+    # pagination compares (sort_key, id) row values, which never match NULL
+    cur.execute("""UPDATE books SET sort_key = '' WHERE sort_key IS NULL""")
+
+@migration(7)
+def add_indexes(cur):
+    cur.execute("""CREATE INDEX books_sort_key ON books (sort_key)""")
+    cur.execute("""CREATE INDEX books_collection ON books (collection_id, sort_key)""")
+    cur.execute("""CREATE INDEX books_authors ON books (authors, sort_key)""")
+    cur.execute("""CREATE INDEX books_isbn ON books (isbn)""")
+    cur.execute("""
+        CREATE INDEX books_lent_out ON books (sort_key)
+        WHERE borrowed_to IS NOT NULL
+    """)
+    cur.execute("""CREATE INDEX collections_name ON collections (name COLLATE NOCASE)""")
+
+@migration(8)
+def add_metadata_cache(cur):
+    cur.execute("""
+        CREATE TABLE metadata_cache
+        (
+            isbn VARCHAR(13) PRIMARY KEY,  -- always ISBN-13
+            provider TEXT,
+            data TEXT,  -- JSON as returned by the provider; null: nothing found
+            fetched_at TIMESTAMP DEFAULT (datetime('now'))
+        )
+    """)
+
+@migration(9)
+def add_authors(cur):
+    cur.execute("""
+        CREATE TABLE authors
+        (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE,
+            sort_key TEXT,
+            book_count INTEGER NOT NULL DEFAULT 0  -- maintained by triggers
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE book_authors
+        (
+            author_id INTEGER,
+            book_id INTEGER,
+            PRIMARY KEY (author_id, book_id),
+            FOREIGN KEY(author_id) REFERENCES authors(id),
+            FOREIGN KEY(book_id) REFERENCES books(id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""CREATE INDEX book_authors_book ON book_authors (book_id)""")
+    cur.execute("""
+        CREATE INDEX authors_listed ON authors (sort_key)
+        WHERE book_count > 0
+    """)
+    cur.execute("""
+        CREATE TRIGGER count_book_authors_insert
+        AFTER INSERT ON book_authors
+        BEGIN
+            UPDATE authors SET book_count = book_count + 1 WHERE id = NEW.author_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER count_book_authors_delete
+        AFTER DELETE ON book_authors
+        BEGIN
+            UPDATE authors SET book_count = book_count - 1 WHERE id = OLD.author_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER unlink_deleted_book
+        AFTER DELETE ON books
+        BEGIN
+            DELETE FROM book_authors WHERE book_id = OLD.id;
+        END
+    """)
+    for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""
+            CREATE TRIGGER log_authors_{event.lower()}
+            AFTER {event} ON authors
+            BEGIN
+                INSERT INTO changes (table_name, row_id) VALUES ('authors', {ref}.id);
+            END
+        """)
+    for book_id, authors in cur.execute("SELECT id, authors FROM books").fetchall():
+        for name in split_authors(authors):
+            cur.execute(
+                """
+                INSERT INTO authors (name, sort_key) VALUES (?, ?)
+                ON CONFLICT (name) DO NOTHING
+                """,
+                (name, author_sort_key(name)),
+            )
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO book_authors (author_id, book_id)
+                SELECT id, ? FROM authors WHERE name = ?
+                """,
+                (book_id, name),
+            )
+    cur.execute("""DROP INDEX books_authors""")
+
+
+def sort_key_sql(book_id, title):
+    # the authors' precomputed sort keys in order, then the title;
+    # char(1114109) (U+10FFFD) makes sure it's always sorted by authors
+    # first. Books without authors get an empty key.
+    return f"""COALESCE(
+        (
+            SELECT group_concat(sort_key, ' ')
+            FROM (
+                SELECT authors.sort_key
+                FROM book_authors
+                JOIN authors ON authors.id = book_authors.author_id
+                WHERE book_authors.book_id = {book_id}
+                ORDER BY book_authors.position
+            )
+        ) || ' ' || char(1114109) || ' ' || COALESCE(unicode_upper({title}), ''),
+        ''
+    )"""
+
+
+def link_authors(cur, book_id, authors):
+    # the authors' book counts follow along through triggers
+    cur.execute("DELETE FROM book_authors WHERE book_id = ?", (book_id,))
+    for position, name in enumerate(split_authors(authors)):
+        cur.execute(
+            """
+            INSERT INTO authors (name, sort_key) VALUES (?, ?)
+            ON CONFLICT (name) DO NOTHING
+            """,
+            (name, author_sort_key(name)),
+        )
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO book_authors (author_id, book_id, position)
+            SELECT id, ?, ? FROM authors WHERE name = ?
+            """,
+            (book_id, position, name),
+        )
+
+
+@migration(10)
+def add_author_positions(cur):
+    # a book's sort key lists its authors in the order they were given
+    cur.execute("""ALTER TABLE book_authors ADD position INTEGER NOT NULL DEFAULT 0""")
+    for book_id, authors in cur.execute("SELECT id, authors FROM books").fetchall():
+        link_authors(cur, book_id, authors)
+
+
+@migration(11)
+def maintain_sort_key(cur):
+    # sort keys used to be filled in lazily whenever a book without one was
+    # read; now they are kept up to date on every write instead
+    for name, event, ref in (
+        ("link", "INSERT", "NEW"),
+        ("unlink", "DELETE", "OLD"),
+    ):
+        cur.execute(f"""
+            CREATE TRIGGER sort_key_on_{name}
+            AFTER {event} ON book_authors
+            BEGIN
+                UPDATE books
+                SET sort_key = {sort_key_sql("books.id", "books.title")}
+                WHERE id = {ref}.book_id;
+            END
+        """)
+    cur.execute(f"""
+        CREATE TRIGGER sort_key_on_title
+        AFTER UPDATE OF title ON books
+        BEGIN
+            UPDATE books
+            SET sort_key = {sort_key_sql("NEW.id", "NEW.title")}
+            WHERE id = NEW.id;
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER sort_key_on_author
+        AFTER UPDATE OF sort_key ON authors
+        WHEN NEW.sort_key IS NOT OLD.sort_key
+        BEGIN
+            UPDATE books
+            SET sort_key = {sort_key_sql("books.id", "books.title")}
+            WHERE id IN (SELECT book_id FROM book_authors WHERE author_id = NEW.id);
+        END
+    """)
+    cur.execute(f"""
+        UPDATE books SET sort_key = {sort_key_sql("books.id", "books.title")}
+    """)
+
+@migration(12)
+def add_recalculations(cur):
+    # progress of the background sort key recalculation, committed along
+    # with every chunk so that it can be resumed after a restart
+    cur.execute("""
+        CREATE TABLE recalculations
+        (
+            id INTEGER PRIMARY KEY,
+            last_author_id INTEGER NOT NULL DEFAULT 0,
+            last_book_id INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL,
+            started_at TIMESTAMP DEFAULT (datetime('now')),
+            finished_at TIMESTAMP
+        )
+    """)
+
+@migration(13)
+def add_book_version(cur):
+    # bumped by every write to a book, so that HTML rendered from an older
+    # version of it is never mistaken for current
+    cur.execute("""ALTER TABLE books ADD version INTEGER NOT NULL DEFAULT 0""")
+
+@migration(14)
+def add_import_jobs(cur):
+    # progress of bulk imports, so that any worker can report it
+    cur.execute("""
+        CREATE TABLE import_jobs
+        (
+            id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            imported INTEGER NOT NULL DEFAULT 0,
+            not_found INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT (datetime('now'))
+        )
+    """)
+
+@migration(15)
+def add_unfinished_recalculations_index(cur):
+    # workers look for a recalculation to resume at every start
+    cur.execute("""
+        CREATE INDEX recalculations_unfinished ON recalculations (id)
+        WHERE finished_at IS NULL
+    """)
@@ -0,0 +1,132 @@
+import os
+import asyncio
+
+import db
+import metadata
+import objects as O
+
+WORKERS = int(os.environ.get("OOK_IMPORT_WORKERS", 4))
+MAX_ATTEMPTS = int(os.environ.get("OOK_IMPORT_ATTEMPTS", 4))
+RECALC_CHUNK = int(os.environ.get("OOK_RECALC_CHUNK", 1000))
+
+queue = None
+workers = []
+recalculations = {}
+
+
+def start_import(total, rejected):
+    # the progress of imports is kept in the database, so that whichever
+    # worker gets asked about it can tell
+    with db.transaction() as cur:
+        cur.execute(
+            "INSERT INTO import_jobs (total, rejected) VALUES (?, ?)",
+            (total, rejected),
+        )
+        return cur.lastrowid
+
+
+def count_import(job_id, outcome):
+    # outcome is one of the columns imported, not_found and failed
+    with db.transaction() as cur:
+        cur.execute(
+            f"UPDATE import_jobs SET {outcome} = {outcome} + 1 WHERE id = ?",
+            (job_id,),
+        )
+
+
+def get_import(job_id):
+    with db.reading() as cur:
+        return cur.execute(
+            "SELECT * FROM import_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+
+
+def ensure_workers():
+    global queue
+    if queue is None:
+        queue = asyncio.Queue()
+        for _ in range(WORKERS):
+            workers.append(asyncio.create_task(work()))
+
+
+async def enqueue(books, rejected=()):
+    ensure_workers()
+    job_id = await db.run(start_import, len(books), len(rejected))
+    for book in books:
+        queue.put_nowait((job_id, book, 1))
+    return job_id
+
+
+async def work():
+    loop = asyncio.get_running_loop()
+    while True:
+        job_id, book, attempt = await queue.get()
+        outcome = None
+        try:
+            data, failed = await metadata.resolve(book.isbn)
+            if data:
+                await book.import_metadata(data)
+                outcome = "imported"
+            elif failed and attempt < MAX_ATTEMPTS:
+                # some provider was unreachable: try again later, without
+                # keeping this worker busy in the meantime
+                loop.call_later(2 ** attempt, queue.put_nowait, (job_id, book, attempt + 1))
+            elif failed:
+                outcome = "failed"
+            else:
+                outcome = "not_found"
+        except Exception as e:
+            print("Failed to import", book.isbn, e)
+            outcome = "failed"
+        finally:
+            queue.task_done()
+        if outcome:
+            await db.run(count_import, job_id, outcome)
+
+
+def start_recalculation():
+    # there is only ever one recalculation running; asking again just
+    # returns that one
+    with db.transaction() as cur:
+        row = cur.execute(
+            "SELECT id FROM recalculations WHERE finished_at IS NULL"
+        ).fetchone()
+        if row:
+            return row["id"]
+        cur.execute("INSERT INTO recalculations (total) SELECT count(*) FROM books")
+        return cur.lastrowid
+
+
+def get_recalculation(recalculation_id):
+    with db.reading() as cur:
+        return cur.execute(
+            "SELECT * FROM recalculations WHERE id = ?", (recalculation_id,)
+        ).fetchone()
+
+
+def unfinished_recalculations():
+    with db.reading() as cur:
+        return [
+            row["id"] for row in
+            cur.execute("SELECT id FROM recalculations WHERE finished_at IS NULL")
+        ]
+
+
+def ensure_recalculation(recalculation_id):
+    if recalculation_id not in recalculations:
+        recalculations[recalculation_id] = asyncio.create_task(
+            recalculate(recalculation_id),
+        )
+
+
+async def recalculate(recalculation_id):
+    # every chunk is its own transaction on the thread pool, so that requests
+    # keep being served in between
+    try:
+        while await db.run(O.Book.recalculate_sort_keys, recalculation_id, RECALC_CHUNK):
+            pass
+        print("Recalculated all sort keys")
+    except Exception as e:
+        print("Failed to recalculate sort keys", e)
+    finally:
+        del recalculations[recalculation_id]
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import isbnlib
+import isbnlib.config
+from isbnlib.registry import bibformatters, add_service
+
+import db
+import metrics
+
+bibjson = bibformatters["json"]
+
+# e.g. OOK_ISBN_PROVIDERS="goob:3,openl,wiki:10": providers are asked in this
+# order, each with its own timeout in seconds
+DEFAULT_TIMEOUT = float(os.environ.get("OOK_ISBN_TIMEOUT", 5))
+PROVIDERS = {}
+for spec in os.environ.get("OOK_ISBN_PROVIDERS", "goob,openl,wiki").split(","):
+    name, _, timeout = spec.strip().partition(":")
+    PROVIDERS[name] = float(timeout) if timeout else DEFAULT_TIMEOUT
+
+# don't let abandoned lookups hog executor threads for much longer than we
+# wait for them
+isbnlib.config.seturlopentimeout(max(PROVIDERS.values()))
+
+# how long (in seconds) looked up metadata is reused, and how long we believe
+# that there is none when no provider knew the ISBN
+CACHE_TTL = float(os.environ.get("OOK_ISBN_CACHE_TTL", 60 * 60 * 24 * 90))
+NEGATIVE_CACHE_TTL = float(os.environ.get("OOK_ISBN_NEGATIVE_CACHE_TTL", 60 * 60 * 24))
+
+STUB_URL = os.environ.get("OOK_ISBN_STUB_URL")
+
+
+def query_stub(isbn):
+    with urllib.request.urlopen(f"{STUB_URL}/{isbn}", timeout=PROVIDERS["stub"]) as response:
+        return json.load(response)
+
+
+if STUB_URL:
+    add_service("stub", query_stub)
+
+
+# start asking the next provider if the previous ones haven't answered
+# within this many seconds; 0 asks all of them at once
+HEDGE_DELAY = float(os.environ.get("OOK_ISBN_HEDGE_DELAY", 1))
+ADAPTIVE = os.environ.get("OOK_ISBN_ADAPTIVE", "1") == "1"
+# maximum number of requests per second we send to any one provider
+RATE_LIMIT = float(os.environ.get("OOK_ISBN_RATE_LIMIT", 5))
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class ProviderStats:
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.failures = 0
+        self.latency = None  # exponentially weighted moving average
+
+    def record(self, seconds, *, hit=False, failed=False):
+        self.calls += 1
+        self.hits += hit
+        self.failures += failed
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    @property
+    def success_rate(self):
+        # smoothed, so that a single miss doesn't rule a provider out
+        return (self.hits + 1) / (self.calls + 1)
+
+    def expected_cost(self, timeout):
+        latency = timeout / 2 if self.latency is None else self.latency
+        return latency / self.success_rate
+
+
+STATS = {provider: ProviderStats() for provider in PROVIDERS}
+lookup_duration = metrics.Histogram(
+    "ook_isbn_lookup_duration_seconds",
+    "ISBN lookups by provider and whether they found the book, found nothing or failed",
+    ("provider", "outcome"),
+)
+LIMITERS = {provider: RateLimiter(RATE_LIMIT) for provider in PROVIDERS}
+
+
+def ranked_providers():
+    providers = list(PROVIDERS)
+    if ADAPTIVE:
+        providers.sort(key=lambda p: STATS[p].expected_cost(PROVIDERS[p]))
+    return providers
+
+
+async def query(isbn, provider):
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(None, isbnlib.meta, isbn, provider),
+        PROVIDERS[provider],
+    )
+
+
+async def lookup(isbn, provider):
+    await LIMITERS[provider].wait()
+    start = time.perf_counter()
+    try:
+        meta = await query(isbn, provider)
+        data = bibjson(meta) if meta else None
+    except isbnlib.NotValidISBNError:
+        raise
+    except Exception:
+        seconds = time.perf_counter() - start
+        STATS[provider].record(seconds, failed=True)
+        lookup_duration.observe(seconds, provider=provider, outcome="failure")
+        return None
+    seconds = time.perf_counter() - start
+    STATS[provider].record(seconds, hit=bool(data))
+    lookup_duration.observe(seconds, provider=provider, outcome="hit" if data else "miss")
+    return json.loads(data) if isinstance(data, str) else data or {}
+
+
+def cache_key(isbn):
+    return isbnlib.to_isbn13(isbnlib.canonical(isbn)) or None
+
+
+def read_cache(key):
+    with db.reading() as cur:
+        row = cur.execute(
+            """
+            SELECT data
+            FROM metadata_cache
+            WHERE isbn = ?
+            AND fetched_at > datetime(
+                'now',
+                CASE WHEN data IS NULL THEN ? ELSE ? END
+            )
+            """,
+            (key, f"-{NEGATIVE_CACHE_TTL} seconds", f"-{CACHE_TTL} seconds"),
+        ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row["data"]) if row["data"] else {}
+
+
+def write_cache(key, provider, data):
+    with db.transaction() as cur:
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO metadata_cache (isbn, provider, data)
+            VALUES (?, ?, ?)
+            """,
+            (key, provider, json.dumps(data) if data else None),
+        )
+
+
+async def get_first_isbn_match(isbn):
+    data, _ = await resolve(isbn)
+    return data
+
+
+async def resolve(isbn):
+    """Look up metadata for an ISBN.
+
+    Returns the metadata (empty if there is none) and whether the result is
+    preliminary because some provider failed to answer.
+    """
+    key = cache_key(isbn)
+    if key and (data := await db.run(read_cache, key)) is not None:
+        return data, False
+    providers = ranked_providers()
+    waiting = list(providers)
+    running = set()
+    failed = False
+    try:
+        while waiting or running:
+            if waiting:
+                provider = waiting.pop(0)
+                running.add(asyncio.create_task(lookup(isbn, provider), name=provider))
+            done, running = await asyncio.wait(
+                running,
+                timeout=HEDGE_DELAY if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in sorted(done, key=lambda task: providers.index(task.get_name())):
+                if data := task.result():
+                    if key:
+                        await db.run(write_cache, key, task.get_name(), data)
+                    return data, False
+                failed = failed or data is None
+    finally:
+        for task in running:
+            task.cancel()
+    if key and not failed:
+        # every provider answered, none of them knows this ISBN
+        await db.run(write_cache, key, None, {})
+    return {}, failed
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0
+
+    def do_GET(self):
+        isbn = self.path.strip("/")
+        time.sleep(self.delay)
+        body = json.dumps({
+            "ISBN-13": isbn,
+            "Title": f"Book {isbn}",
+            "Authors": [f"Author {isbn[-2:]}"],
+            "Publisher": "Stub Press",
+            "Year": "2000",
+            "Language": "en",
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_stub(port=8001, delay=0):
+    # answers every ISBN with made-up metadata; point the app at it with
+    # OOK_ISBN_PROVIDERS=stub OOK_ISBN_STUB_URL=http://localhost:8001
+    StubHandler.delay = delay
+    server = ThreadingHTTPServer(("localhost", port), StubHandler)
+    print(f"Serving stub metadata on http://localhost:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve_stub(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 8001,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 0,
+    )
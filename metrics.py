@@ -0,0 +1,132 @@
+import os
+import time
+import bisect
+import asyncio
+
+# on by default; it costs a few percent on pages that read many rows, as
+# every statement and fetch is timed
+ENABLED = os.environ.get("OOK_METRICS", "1") == "1"
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_INTERVAL = 0.5
+
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric family with fixed label names.
+
+    Values are either recorded as they happen, or read from `collect` (a
+    function returning `{label values: value}`) when the metrics are scraped.
+    Everything is recorded on the event loop, so there is no locking.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for name, labels, value in self.samples():
+            yield f"{name}{format_labels(labels)} {format_value(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if (entry := self.values.get(key)) is None:
+            # counts per bucket, the last one for everything above them, and the sum
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+event_loop_lag = Histogram(
+    "ook_event_loop_lag_seconds",
+    "How much later than scheduled the event loop woke up a sleeping task",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+_watcher = None
+
+
+async def measure_lag():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        event_loop_lag.observe(max(0, time.perf_counter() - start - LAG_INTERVAL))
+
+
+def watch_event_loop():
+    global _watcher
+    if _watcher is None or _watcher.done():
+        _watcher = asyncio.create_task(measure_lag())
@@ -0,0 +1,23 @@
+import re
+import unicodedata
+
+
+def split_authors(authors):
+    # the same name can arrive composed or decomposed, depending on where
+    # the metadata came from
+    names = (
+        " ".join(unicodedata.normalize("NFC", name).split())
+        for name in (authors or "").split(",")
+    )
+    return [name for name in names if name]
+
+
+def author_sort_key(name):
+    # the following decomposes all diacritics, hopefully sorting "Faruk
+    # Šehić" under "S".
+    name = unicodedata.normalize("NFKD", name)
+    norm = re.sub(r"\([^)]+\)", "", name.strip()).strip()
+    fnames, _, lname = norm.rpartition(" ")
+    if fnames:
+        return f"{lname} {fnames}".upper()
+    return lname.upper()
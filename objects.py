@@ -1,149 +1,441 @@
+import os
 import re
+import sys
+import threading
 import json
+import base64
 import random
 import string
-import unicodedata
 import hashlib
 from datetime import date, datetime
-from types import SimpleNamespace
-
-import isbnlib
-from isbnlib.registry import bibformatters
-
-from db import conn
-
-bibjson = bibformatters["json"]
-
-def get_first_isbn_match(isbn):
-    data = {}
-    for provider in ("goob", "openl", "wiki"):
+from urllib.parse import quote
+
+import db
+from cache import LRUCache
+from metadata import get_first_isbn_match
+from names import author_sort_key
+from templates import Template
+
+def fts_query(q):
+    # every word has to match as a prefix, so results narrow down while the
+    # user is still typing. Diacritics and case are folded by the tokenizer.
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", q))
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def decode_cursor(token):
+    # cursors come from the URL, so they can be anything
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except ValueError:
+        raise InvalidCursor(f"Invalid cursor: {token!r}") from None
+    if not (
+        isinstance(key, list)
+        and len(key) == 2
+        and isinstance(key[0], str)
+        and type(key[1]) is int
+    ):
+        raise InvalidCursor(f"Invalid cursor: {token!r}")
+    return key
+
+
+class KeysetPage:
+    """One page of results after or before a cursor, read as it is iterated.
+
+    `rows` are up to size + 1 rows in display order, and `key(row)` the values
+    they are ordered by. The cursor of the previous page is known once the
+    first row was read, the one of the next page once all of them were (None
+    if there is none). Pages before a cursor are read completely up front.
+    """
+
+    def __init__(self, rows, *, key, after=None, before=None, size=20):
+        self.rows = rows
+        self.key = key
+        self.after = after
+        self.before = before
+        self.size = size
+        self.prev_cursor = None
+        self.next_cursor = None
+
+    def __iter__(self):
         try:
-            if data := bibjson(isbnlib.meta(isbn, service=provider)):
-                break
-        except isbnlib.NotValidISBNError:
-            raise
-        except Exception:
-            continue
-    return json.loads(data) if isinstance(data, str) else data
+            if self.before is not None:
+                rows = list(self.rows)
+                if len(rows) > self.size:
+                    rows = rows[-self.size:]
+                    self.prev_cursor = encode_cursor(self.key(rows[0]))
+                if rows:
+                    self.next_cursor = encode_cursor(self.key(rows[-1]))
+                yield from rows
+                return
+            last = None
+            for i, row in enumerate(self.rows):
+                if i == self.size:
+                    self.next_cursor = encode_cursor(self.key(last))
+                    break
+                if i == 0 and self.after is not None:
+                    self.prev_cursor = encode_cursor(self.key(row))
+                last = row
+                yield row
+        finally:
+            if hasattr(self.rows, "close"):
+                self.rows.close()
+
+
+def keyset_page(fetch, *, key, after=None, before=None, size=20):
+    """Fetch one page of results after or before a cursor.
+
+    `fetch(after, before, limit)` has to return rows in display order, and
+    `key(row)` the values the rows are ordered by. Returns the rows of the
+    page and the cursors of the previous and next page (None if there is
+    none).
+    """
+    page = KeysetPage(
+        fetch(after, before, size + 1), key=key, after=after, before=before, size=size,
+    )
+    rows = list(page)
+    return rows, page.prev_cursor, page.next_cursor
+
 
 UNSET = object()
 class lazy:
     def __init__(self, name):
         self.value = UNSET
         self.name = name
+        self.attribute = f"_{name}"
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
-        if getattr(instance, f"_{self.name}", UNSET) is UNSET:
-            +instance
-        return getattr(instance, f"_{self.name}")
+        value = getattr(instance, self.attribute, UNSET)
+        if value is UNSET:
+            instance.load_missing(self.name)
+            value = getattr(instance, self.attribute)
+        return value
 
     def __set__(self, instance, value):
-        setattr(instance, f"_{self.name}", value)
+        setattr(instance, self.attribute, value)
+
+
+CACHE_SIZE = int(os.environ.get("OOK_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("OOK_CACHE_TTL", 300))
+FRAGMENT_CACHE_SIZE = int(os.environ.get("OOK_FRAGMENT_CACHE_SIZE", 20000))
+FRAGMENT_CACHE_MB = float(os.environ.get("OOK_FRAGMENT_CACHE_MB", 16))
+# report objects from listings that still load fields one by one, i.e.
+# fields missing from the listing's projection
+DEBUG_LOADS = os.environ.get("OOK_DEBUG_LOADS") == "1"
+
+# rendered HTML of books by (id, row version, format spec), plus the id of
+# their collection if they show its name; writes bump the version, so
+# outdated fragments are never found again and just age out
+fragments = LRUCache(
+    FRAGMENT_CACHE_SIZE,
+    maxweight=int(FRAGMENT_CACHE_MB * 2**20),
+    weigh=sys.getsizeof,
+)
+
+
+def forget_collection_fragments(collection_id):
+    """Drop the fragments that show the name of a collection"""
+    fragments.remove_if(lambda key: key[3:] == (collection_id,))
+
+
+def slots(fields):
+    """__slots__ for a model, holding the values of its lazy fields"""
+    return tuple(f"_{field}" for field in fields)
 
 
 class Model:
+    # no __dict__ per object: the identity maps hold many thousands of them,
+    # and the dict would take up more memory than the object itself
+    __slots__ = ("id", "_listed")
+    # SQL for fields that aren't simply the column of the same name
+    columns = {}
+
     def __new__(cls, id):
-        if id in cls._cache:
-            return cls._cache[id]
-        obj = super(Model, cls).__new__(cls)
-        cls._cache[id] = obj
-        obj._populated = False
+        obj = cls._cache.get(id)
+        if obj is None:
+            obj = super(Model, cls).__new__(cls)
+            obj = cls._cache.setdefault(id, obj)
         return obj
 
     def __init__(self, id):
         self.id = id
+        # asked for by id, so loading its fields one by one is expected
+        self._listed = False
 
     def __pos__(self):
-        if not self._populated:
-            self._populated = True
-            self.populate()
+        if missing := self.missing():
+            self.load(missing)
         return self
 
     def __repr__(self):
-        return f"<{type(self).__name__} id={self.id}{'+' if self._populated else '-'}>"
+        return f"<{type(self).__name__} id={self.id}{'-' if self.missing() else '+'}>"
 
     def __init_subclass__(cls):
-        cls._cache = {}
+        if "__slots__" not in cls.__dict__:
+            raise TypeError(f"{cls.__name__} needs `__slots__ = slots(fields)`")
+        cls._cache = LRUCache(CACHE_SIZE, ttl=CACHE_TTL)
         for field in cls.fields:
             setattr(cls, field, lazy(field))
 
+    @classmethod
+    def selection(cls, fields=None):
+        """The columns for `fields` (all by default) and where they come from"""
+        columns = [f"{cls.table_name}.id"]
+        for field in cls.fields if fields is None else fields:
+            columns.extend(cls.columns.get(field, (f"{cls.table_name}.{field}",)))
+        return f"{', '.join(columns)} FROM {getattr(cls, 'source', cls.table_name)}"
+
+    def missing(self):
+        return [
+            field for field in self.fields
+            if getattr(self, f"_{field}", UNSET) is UNSET
+        ]
+
+    def load(self, fields):
+        with db.reading() as cur:
+            row = cur.execute(
+                f"SELECT {self.selection(fields)} WHERE {self.table_name}.id = ?",
+                (self.id,),
+            ).fetchone()
+        if not row:
+            raise ValueError(f"No {type(self).__name__} with this ID found")
+        self.hydrate(row)
+
+    def unload(self):
+        """Forget the fields, so that they are read again when next used"""
+        for field in self.fields:
+            setattr(self, f"_{field}", UNSET)
+        self._listed = False
+
+    def load_missing(self, field):
+        # everything that's missing comes in one query, as whatever needed
+        # this field probably needs the others too
+        missing = self.missing()
+        if DEBUG_LOADS and self._listed:
+            print(
+                f"{self!r} was listed without {field!r}, loading"
+                f" {', '.join(missing)} on its own"
+            )
+        self.load(missing)
+
+    def hydrate(self, row):
+        keys = row.keys()
+        for field in self.fields:
+            if field in keys:
+                setattr(self, field, row[field])
+
+    @classmethod
+    def from_row(cls, row):
+        # prime the identity map from an already fetched row, so listings
+        # don't need one query per object; fields not in the row are loaded
+        # when they are first used
+        obj = cls(row["id"])
+        obj._listed = True
+        obj.hydrate(row)
+        return obj
+
     @classmethod
     def all(cls, *, order_by="id ASC", offset=0, limit=20):
-        cur = conn.cursor()
-        for row in cur.execute(
-            f"""
-            SELECT
-                id
-            FROM {getattr(cls, "table_name", f"{cls.__name__.lower()}s")}
-            ORDER BY {order_by}
-            LIMIT {limit}
-            OFFSET {offset}
+        with db.reading() as cur:
+            rows = cur.execute(
+                f"""
+                SELECT
+                    {cls.selection()}
+                ORDER BY {order_by}
+                LIMIT {limit}
+                OFFSET {offset}
+                """
+            ).fetchall()
+        return [cls.from_row(row) for row in rows]
+
+
+_last_change = None
+_last_changed_at = None
+_sync_lock = threading.Lock()
+
+
+def sync_caches():
+    """Forget cached objects whose rows were changed since the last call.
+
+    The change log is filled by triggers, so this also catches writes done by
+    other worker processes.
+    """
+    global _last_change, _last_changed_at
+    with _sync_lock, db.reading() as cur:
+        if _last_change is None:
+            row = cur.execute(
+                "SELECT id, changed_at FROM changes WHERE id = (SELECT max(id) FROM changes)"
+            ).fetchone()
+            _last_change, _last_changed_at = row or (0, None)
+            return
+        rows = cur.execute(
             """
-        ).fetchall():
-            yield cls(row["id"])
+            SELECT id, table_name, row_id, changed_at
+            FROM changes
+            WHERE id > ?
+            ORDER BY id
+            """,
+            (_last_change,),
+        ).fetchall()
+        if not rows:
+            return
+        models = {model.table_name: model for model in Model.__subclasses__()}
+        if rows[0]["id"] > _last_change + 1:
+            # we fell so far behind that the log was pruned in between
+            for model in models.values():
+                model._cache.clear()
+            fragments.clear()
+        else:
+            changed_books = set()
+            for row in rows:
+                if row["table_name"] == "collections":
+                    # cached books hold on to their collection, so it is
+                    # reloaded in place instead of being replaced
+                    if (collection := Collection._cache.get(row["row_id"])) is not None:
+                        collection.unload()
+                    forget_collection_fragments(row["row_id"])
+                    continue
+                models[row["table_name"]]._cache.pop(row["row_id"])
+                if row["table_name"] == "books":
+                    changed_books.add(row["row_id"])
+            if changed_books:
+                # versions only tell apart the states of one book: the id of
+                # a deleted book can come back, starting over at version 0
+                fragments.remove_if(lambda key: key[0] in changed_books)
+        _last_change = rows[-1]["id"]
+        _last_changed_at = rows[-1]["changed_at"]
+
+
+def data_version():
+    """The id and time of the last change seen by sync_caches()
+
+    Everything shown on the catalog pages is covered by the change log, so
+    they can only look different once this changed.
+    """
+    return _last_change, _last_changed_at
+
+
+def unit_of_work():
+    """Group writes into one transaction: `with unit_of_work(): ...`
+
+    The model methods that write already commit through their own unit of
+    work; inside this one, they all take effect together or not at all.
+    """
+    return db.transaction()
+
+
+def cache_stats():
+    return {
+        **{model.__name__: model._cache.stats() for model in Model.__subclasses__()},
+        "fragments": fragments.stats(),
+    }
 
 
 class Collection(Model):
     table_name = "collections"
     fields = ("name",)
-
-    def populate(self):
-        cur = conn.cursor()
-        row = cur.execute(
-            """
-                SELECT
-                    id, name
-                FROM collections
-                WHERE id = ?
-            """,
-            (self.id,),
-        ).fetchone()
-        if not row:
-            raise ValueError("No Collection with this ID found")
-        self.name = row["name"]
+    __slots__ = slots(fields)
 
     @classmethod
     def new(cls, name):
-        cur = conn.cursor()
-        cur.execute("INSERT INTO collections (name) VALUES (?)", (name,))
-        conn.commit()
-        return cls(cur.lastrowid)
+        with db.transaction() as cur:
+            cur.execute("INSERT INTO collections (name) VALUES (?)", (name,))
+        return cls.from_row({"id": cur.lastrowid, "name": name})
 
     def rename(self, name):
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE collections
-            SET name=?
-            WHERE id = ?
-            """,
-            (name, self.id),
-        )
-        conn.commit()
+        with db.transaction() as cur:
+            cur.execute(
+                """
+                UPDATE collections
+                SET name=?
+                WHERE id = ?
+                """,
+                (name, self.id),
+            )
         self.name = name
+        forget_collection_fragments(self.id)
 
-    def __format__(self, fmt):
-        if fmt == "heading":
-            return f"""<h3
-                hx-post="/collections/{self.id}/rename"
+    templates = {
+        "heading": Template("""<h3
+                hx-post="/collections/{collection.id}/rename"
                 hx-swap="outerHTML"
                 hx-trigger="blur delay:500ms"
                 hx-target="closest h3"
                 hx-vals="javascript: name:htmx.find('h3').innerHTML"
                 contenteditable
-            >{self.name}</h3>
-            """
-        else:
-            return f"""<a
+            >{collection.name}</h3>
+            """),
+        "": Template("""<a
                 class="clickable collection"
                 hx-push-url="true"
-                href="/collections/{self.id}"
+                href="/collections/{collection.id}"
                 hx-select="#container"
                 hx-target="#container"
                 hx-swap="outerHTML"
-            ><strong>{self.name}</strong></a>"""
+            ><strong>{collection.name}</strong></a>"""),
+    }
+
+    def __format__(self, fmt):
+        return self.templates.get(fmt, self.templates[""]).render(collection=self)
+
+    def __str__(self):
+        return f"{self}"
+
+
+class Author(Model):
+    table_name = "authors"
+    fields = ("name", "sort_key", "book_count")
+    __slots__ = slots(fields)
+
+    @classmethod
+    def all(cls, *, after=None, before=None, limit=20):
+        conditions = ["book_count > 0"]
+        values = []
+        order = "ASC"
+        if after is not None:
+            conditions.append("(sort_key, id) > (?, ?)")
+            values.extend(decode_cursor(after))
+        elif before is not None:
+            conditions.append("(sort_key, id) < (?, ?)")
+            values.extend(decode_cursor(before))
+            order = "DESC"
+        with db.reading() as cur:
+            rows = cur.execute(
+                f"""
+                SELECT
+                    id, name, sort_key, book_count
+                FROM authors
+                WHERE {" AND ".join(conditions)}
+                ORDER BY sort_key {order}, id {order}
+                LIMIT {limit}
+                """,
+                tuple(values),
+            ).fetchall()
+        if order == "DESC":
+            rows.reverse()
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def page(cls, *, after=None, before=None, size=20):
+        return keyset_page(
+            lambda after, before, limit: cls.all(after=after, before=before, limit=limit),
+            key=lambda author: (author.sort_key, author.id),
+            after=after,
+            before=before,
+            size=size,
+        )
+
+    def __format__(self, fmt):
+        return f"""<a href="/books?author={quote(self.name)}">{self.name}</a>"""
 
     def __str__(self):
         return f"{self}"
@@ -161,8 +453,21 @@ class Book(Model):
         "imported_at",
         "collection",
         "sort_key",
+        "version",
     )
+    __slots__ = slots(fields)
     table_name = "books"
+    # books come with the name of their collection, so that showing it
+    # doesn't need a query per book
+    source = "books LEFT JOIN collections ON collections.id = books.collection_id"
+    columns = {"collection": ("books.collection_id", "collections.name AS collection_name")}
+    # the fields listings need for rendering books in these formats
+    projections = {
+        "spine": ("title", "authors", "isbn", "borrowed_to", "sort_key", "version"),
+        "table-row": ("title", "authors", "borrowed_to", "collection", "sort_key", "version"),
+    }
+    # by format spec, whether the fragments show the name of the collection
+    _shows_collection = {}
 
     palettes = [
         [
@@ -218,7 +523,7 @@ class Book(Model):
     @property
     def style(self):
         random_state = int(self.isbn)
-        author_state = int(hashlib.md5(self.authors.encode()).hexdigest(), 16)
+        author_state = int(hashlib.md5((self.authors or "").encode()).hexdigest(), 16)
         colors = Book.palettes[author_state % len(Book.palettes)]
         bg, fg = colors[random_state % len(colors)]
         pad = 15 + (random_state % 30) / 10
@@ -238,99 +543,116 @@ class Book(Model):
             return letter
         return "#"
 
-    def calculate_sort_key(self):
-        authors = self.authors
-        if not authors:
-            return ""
-        # the following decomposes all diacritics, hopefully sorting "Faruk
-        # Šehić" under "S".
-        authors = unicodedata.normalize("NFKD", authors)
-        parts = []
-        for author in authors.split(","):
-            norm = re.sub(r"\([^)]+\)", "", author.strip()).strip()
-            fnames, _, lname = norm.rpartition(" ")
-            parts.append(lname)
-            if fnames:
-                parts.append(fnames)
-        parts.append("\U0010fffd")  # ensure it's always sorted by authors
-        parts.append(self.title)
-        return " ".join(parts).upper()
-
-    def populate(self):
-        cur = conn.cursor()
-        row = cur.execute(
-            """
-                SELECT *
-                FROM books
-                WHERE id = ?
-            """,
-            (self.id,),
-        ).fetchone()
-        if not row:
-            raise ValueError("No book with this ID found")
-        self.title = row["title"]
-        self.authors = row["authors"]
-        self.publisher = row["publisher"]
-        self.year = row["year"]
-        self.isbn = row["isbn"]
-        self.created_at = row["created_at"]
-        self.imported_at = row["imported_at"]
-        self.borrowed_to = row["borrowed_to"]
-        self.sort_key = row["sort_key"]
-        if not self.sort_key:
-            print("Updating missing sort_key for", self.title)
-            self.sort_key = self.calculate_sort_key()
-            self.save()
-        if row["collection_id"]:
+    def hydrate(self, row):
+        super().hydrate(row)
+        keys = row.keys()
+        if "collection_id" not in keys:
+            return
+        if row["collection_id"] and "collection_name" in keys:
+            self.collection = Collection.from_row(
+                {"id": row["collection_id"], "name": row["collection_name"]},
+            )
+        elif row["collection_id"]:
             self.collection = Collection(row["collection_id"])
         else:
             self.collection = None
 
     @classmethod
-    def new_from_isbn(cls, isbn, collection_id=None):
+    async def new_from_isbn(cls, isbn, collection_id=None):
         isbn = "".join(c for c in isbn if c in "0123456789")
-        data = get_first_isbn_match(isbn)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO books (isbn, collection_id) VALUES (?, ?)",
-            (isbn, collection_id),
-        )
-        conn.commit()
-        book = Book(cur.lastrowid)
+        data = await get_first_isbn_match(isbn)
+        [book] = await db.run(cls.new_placeholders, [isbn], collection_id)
         if data:
-            book.import_metadata(data)
+            await book.import_metadata(data)
         return book
 
     @classmethod
-    def all_lent_out(cls, *, order_by="id ASC", page_no=0, page_size=20):
-        cur = conn.cursor()
-        for row in cur.execute(
-            f"""
-            SELECT
-                id
-            FROM {getattr(cls, "table_name", f"{cls.__name__.lower()}s")}
-            WHERE borrowed_to IS NOT NULL
-            ORDER BY {order_by}
-            LIMIT {page_size}
-            OFFSET {page_no * page_size}
-            """
-        ).fetchall():
-            yield cls(row["id"])
+    def new_placeholders(cls, isbns, collection_id=None):
+        rows = []
+        with db.transaction() as cur:
+            for isbn in isbns:
+                cur.execute(
+                    """
+                    INSERT INTO books (isbn, collection_id, sort_key)
+                    VALUES (?, ?, '')
+                    """,
+                    (isbn, collection_id),
+                )
+                rows.append(cur.execute(
+                    "SELECT * FROM books WHERE id = ?", (cur.lastrowid,)
+                ).fetchone())
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
-    def recalculate_all_sort_keys(cls):
-        cur = conn.cursor()
-        sort_keys = {}
-        for row in cur.execute(f"SELECT id, title, authors FROM books"):
-            sort_keys[row["id"]] = cls.calculate_sort_key(SimpleNamespace(**row))
-
-        cur.executemany(
-            "UPDATE books SET sort_key=? WHERE id=?",
-            ((key, id) for id, key in sort_keys.items()),
-        )
+    def all_lent_out(cls, *, order_by="sort_key ASC, books.id ASC", page_no=0, page_size=20, fields=None):
+        with db.reading() as cur:
+            rows = cur.execute(
+                f"""
+                SELECT {cls.selection(fields)}
+                WHERE borrowed_to IS NOT NULL
+                ORDER BY {order_by}
+                LIMIT {page_size}
+                OFFSET {page_no * page_size}
+                """
+            ).fetchall()
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def recalculate_sort_keys(cls, recalculation_id, chunk_size=1000):
+        # does one chunk, committed together with the checkpoint; returns
+        # whether there is more to do
+        with db.transaction() as cur:
+            state = cur.execute(
+                "SELECT * FROM recalculations WHERE id = ?", (recalculation_id,)
+            ).fetchone()
+            if state["finished_at"]:
+                return False
+            # authors first, in case the way their sort keys are computed
+            # changed; triggers carry any change over to their books
+            authors = cur.execute(
+                "SELECT id, name FROM authors WHERE id > ? ORDER BY id LIMIT ?",
+                (state["last_author_id"], chunk_size),
+            ).fetchall()
+            if authors:
+                cur.executemany(
+                    "UPDATE authors SET sort_key = ?1 WHERE id = ?2 AND sort_key IS NOT ?1",
+                    ((author_sort_key(row["name"]), row["id"]) for row in authors),
+                )
+                cur.execute(
+                    "UPDATE recalculations SET last_author_id = ? WHERE id = ?",
+                    (authors[-1]["id"], recalculation_id),
+                )
+                return True
+            books = cur.execute(
+                "SELECT id FROM books WHERE id > ? ORDER BY id LIMIT ?",
+                (state["last_book_id"], chunk_size),
+            ).fetchall()
+            if books:
+                cur.execute(
+                    f"""
+                    UPDATE books
+                    SET sort_key = {db.sort_key_sql("books.id", "books.title")}
+                    WHERE id > ? AND id <= ?
+                    """,
+                    (state["last_book_id"], books[-1]["id"]),
+                )
+                cur.execute(
+                    """
+                    UPDATE recalculations
+                    SET last_book_id = ?, done = done + ?
+                    WHERE id = ?
+                    """,
+                    (books[-1]["id"], len(books), recalculation_id),
+                )
+                return True
+            cur.execute(
+                "UPDATE recalculations SET finished_at = datetime('now') WHERE id = ?",
+                (recalculation_id,),
+            )
+            return False
 
-    def import_metadata(self, data=None):
-        data = data or get_first_isbn_match(self.isbn)
+    async def import_metadata(self, data=None):
+        data = data or await get_first_isbn_match(await db.run(getattr, self, "isbn"))
         if data:
             self.title = data.get("title")
             print(data)
@@ -340,137 +662,195 @@ class Book(Model):
             self.publisher = data.get("publisher")
             self.year = data.get("year")
             self.imported_at = datetime.now()
-            self.sort_key = self.calculate_sort_key()
-            self.save()
+            await db.run(self.save)
 
     @classmethod
-    def search(cls, q, *, page_size=20, page_no=0, collection_id=None):
-        cur = conn.cursor()
-        conditions = [
-            """(
-                UPPER(title) LIKE '%' || ? || '%'
-                OR UPPER(authors) LIKE '%' || ? || '%'
-            )"""
-        ]
-        bindings = [q.upper(), q.upper()]
+    def search(cls, q, *, page_size=20, page_no=0, collection_id=None, fields=None):
+        match = fts_query(q)
+        if not match:
+            return cls.all(
+                collection_id=collection_id,
+                offset=page_no * page_size,
+                limit=page_size,
+                fields=fields,
+            )
+        return cls._search(match, page_size, page_no, collection_id, fields)
+
+    @classmethod
+    def _search(cls, match, page_size, page_no, collection_id, fields):
+        conditions = ["books_fts MATCH ?"]
+        bindings = [match]
         if collection_id is not None:
             conditions.append("collection_id = ?")
             bindings.append(collection_id)
-        for row in cur.execute(
-            f"""
-            SELECT
-                id
-            FROM books
-            WHERE {" AND ".join(conditions)}
-            LIMIT {page_size}
-            OFFSET {page_no * page_size}
-            """,
-            tuple(bindings),
-        ).fetchall():
-            yield cls(row["id"])
+        with db.reading() as cur:
+            rows = cur.execute(
+                f"""
+                SELECT {cls.selection(fields)}
+                JOIN books_fts ON books_fts.rowid = books.id
+                WHERE {" AND ".join(conditions)}
+                ORDER BY books_fts.rank
+                LIMIT {page_size}
+                OFFSET {page_no * page_size}
+                """,
+                tuple(bindings),
+            ).fetchall()
+        return [cls.from_row(row) for row in rows]
 
     @classmethod
-    def all(cls, *, order_by="id ASC", collection_id=None, offset=0, limit=20, author=None):
+    def all(cls, **filters):
+        return list(cls.iter_all(**filters))
+
+    @classmethod
+    def iter_all(cls, *, collection_id=None, author=None, after=None, before=None, offset=0, limit=20, fields=None):
         conditions = ["1=1"]
         values = []
         if collection_id is not None:
             conditions.append("collection_id = ?")
             values.append(collection_id)
 
+        joins = ""
         if author is not None:
-            conditions.append("authors = ?")
+            joins = """
+                JOIN book_authors ON book_authors.book_id = books.id
+                JOIN authors ON authors.id = book_authors.author_id
+            """
+            conditions.append("authors.name = ?")
             values.append(author)
 
-        cur = conn.cursor()
-        for row in cur.execute(
-            f"""
-            SELECT
-                id
-            FROM {getattr(cls, "table_name", f"{cls.__name__.lower()}s")}
-            WHERE {" AND ".join(conditions)}
-            ORDER BY {order_by}
-            LIMIT {limit}
-            OFFSET {offset}
-            """,
-            tuple(values),
-        ).fetchall():
-            yield cls(row["id"])
+        order = "ASC"
+        if after is not None:
+            conditions.append("(books.sort_key, books.id) > (?, ?)")
+            values.extend(decode_cursor(after))
+        elif before is not None:
+            # walk backwards from the cursor, and turn the result around below
+            conditions.append("(books.sort_key, books.id) < (?, ?)")
+            values.extend(decode_cursor(before))
+            order = "DESC"
+
+        # a page is only a few rows, so they are read right away (before a
+        # streamed page sends anything, so that a failing query still gets an
+        # error response) and the reader goes back to the pool before any of
+        # them is rendered: a streamed page waits on its client between
+        # chunks, and mustn't hold on to one of the few readers while doing so
+        with db.reading() as cur:
+            rows = cur.execute(
+                f"""
+                SELECT {cls.selection(fields)}
+                {joins}
+                WHERE {" AND ".join(conditions)}
+                ORDER BY books.sort_key {order}, books.id {order}
+                LIMIT {limit}
+                OFFSET {offset}
+                """,
+                tuple(values),
+            ).fetchall()
+        if order == "DESC":
+            rows.reverse()
+        return (cls.from_row(row) for row in rows)
 
-    def __format__(self, fmt):
-        if fmt == "heading":
-            return f"""
+    @classmethod
+    def page(cls, *, after=None, before=None, size=20, **filters):
+        page = cls.stream_page(after=after, before=before, size=size, **filters)
+        books = list(page)
+        return books, page.prev_cursor, page.next_cursor
+
+    @classmethod
+    def stream_page(cls, *, after=None, before=None, size=20, **filters):
+        return KeysetPage(
+            cls.iter_all(after=after, before=before, limit=size + 1, **filters),
+            key=lambda book: (book.sort_key, book.id),
+            after=after,
+            before=before,
+            size=size,
+        )
+
+    templates = {
+        "heading": Template("""
             <span
                 class="booktitle"
-                hx-post="/books/{self.id}/rename"
+                hx-post="/books/{book.id}/rename"
                 hx-swap="outerHTML"
                 hx-trigger="blur delay:500ms"
                 hx-vals="javascript: title:htmx.find('.booktitle').innerHTML"
                 contenteditable
-            >{self.title}</span>
-            """
-        elif fmt == "button-group":
-            return f"""
+            >{book.title}</span>
+            """),
+        "button-group": Template("""
             <div role="group">
-                {self:import-ui}{self:lend-ui}{self:delete-ui}
+                {book:import-ui}{book:lend-ui}{book:delete-ui}
             </div>
-            """
-        elif fmt == "import-ui":
-            if self.title:
-                return ""
-            return f"""<button
+            """),
+        "import-ui": Template("""<button
                 class="secondary"
-                hx-post="/books/{self.id}/fetch"
+                hx-post="/books/{book.id}/fetch"
                 hx-swap="outerHTML"
-            >🔎<span class="hovershow"> Fetch</span></button>"""
-        elif fmt == "delete-ui":
-            return f"""<button
+            >🔎<span class="hovershow"> Fetch</span></button>"""),
+        "delete-ui": Template("""<button
                 class="error"
-                hx-confirm="Do you really want to delete {self.title}?"
-                hx-delete="/books/{self.id}"
-            >🗑<span class="hovershow"> Delete</span></button>"""
-        elif fmt == "lend-ui":
-            if self.borrowed_to:
-                return f"""<button
+                hx-confirm="Do you really want to delete {book.title}?"
+                hx-delete="/books/{book.id}"
+            >🗑<span class="hovershow"> Delete</span></button>"""),
+        "return-ui": Template("""<button
                     class="secondary"
-                    data-tooltip="lent out to {self.borrowed_to}"
+                    data-tooltip="lent out to {book.borrowed_to}"
                     data-placement="left"
-                    hx-confirm="Did {self.borrowed_to} return the book?"
-                    hx-post="/books/{self.id}/return"
+                    hx-confirm="Did {book.borrowed_to} return the book?"
+                    hx-post="/books/{book.id}/return"
                     hx-swap="outerHTML"
-                >🫶<span class="hovershow"> Return</span></button>"""
-            else:
-                return f"""<button
+                >🫶<span class="hovershow"> Return</span></button>"""),
+        "lend-ui": Template("""<button
                     class="secondary"
                     hx-prompt="Who do you want to lend it to?"
-                    hx-post="/books/{self.id}/lend"
+                    hx-post="/books/{book.id}/lend"
                     hx-swap="outerHTML"
-                >🫴<span class="hovershow"> Lend</span></button>"""
-        elif fmt.startswith("table-row"):
-            fields = fmt.partition(":")[-1].split(",")
-            parts = ["<tr>"]
-            for field in fields:
-                if field == "title":
-                    parts.append(f"<td>{self:link}</td>")
-                else:
-                    parts.append(f"<td>{getattr(self, field)}</td>")
-            parts.append("</tr>")
-            return "".join(parts)
-        elif fmt == "spine":
-            return f"""<a
-                href="/books/{self.id}"
+                >🫴<span class="hovershow"> Lend</span></button>"""),
+        "spine": Template("""<a
+                href="/books/{book.id}"
                 class="spine"
-                style="{self.style}"
-            >{self.authors} — {self.title}</a>"""
-        elif fmt == "link":
-            return f"""<a
+                style="{book.style}"
+            >{book.authors} — {book.title}</a>"""),
+        "link": Template("""<a
                 class="clickable book-link"
                 hx-push-url="true"
                 hx-select="#container"
                 hx-target="#container"
                 hx-swap="outerHTML"
-                href="/books/{self.id}"
+                href="/books/{book.id}"
             >
-            {self.title}</a>"""
+            {book.title}</a>"""),
+        "authors-editable": Template(
+            """<td hx-swap="outerHTML" hx-get="/books/{book.id}/authors-form">{book.authors}</td>"""
+        ),
+        "": Template("""<a
+                class="clickable book-link"
+                hx-push-url="true"
+                hx-select="#container"
+                hx-target="#container"
+                hx-swap="outerHTML"
+                href="/books/{book.id}">
+                {book.title}</a>"""),
+    }
+
+    @classmethod
+    def template(cls, fmt):
+        # table rows are compiled once per list of columns, with the title
+        # link inlined
+        if fmt.startswith("table-row") and fmt not in cls.templates:
+            columns = []
+            for field in fmt.partition(":")[-1].split(","):
+                if field == "title":
+                    columns.append(f"<td>{cls.templates['link'].source}</td>")
+                else:
+                    columns.append(f"<td>{{book.{field}}}</td>")
+            cls.templates[fmt] = Template(f"<tr>{''.join(columns)}</tr>")
+        return cls.templates.get(fmt)
+
+    def __format__(self, fmt):
+        if fmt == "import-ui" and self.title:
+            return ""
+        elif fmt == "lend-ui" and self.borrowed_to:
+            fmt = "return-ui"
         elif fmt.startswith("details"):
             parts = []
             if self.borrowed_to:
@@ -489,77 +869,103 @@ class Book(Model):
             parts.append(f"<tr><td><strong>ISBN</strong></td><td>{self.isbn}</td></tr>")
             parts.append("</table>")
             return "".join(parts)
-        elif fmt == "authors-editable":
-            return f"""<td hx-swap="outerHTML" hx-get="/books/{self.id}/authors-form">{self.authors}</td>"""
-        else:
-            return f"""<a
-                class="clickable book-link"
-                hx-push-url="true"
-                hx-select="#container"
-                hx-target="#container"
-                hx-swap="outerHTML"
-                href="/books/{self.id}">
-                {self.title}</a>"""
+        template = self.template(fmt) or self.templates[""]
+        return template.render(book=self)
+
+    def render(self, fmt):
+        """format(book, fmt), but cached until the book changes"""
+        key = (self.id, self.version, fmt)
+        if (shows_collection := self._shows_collection.get(fmt)) is None:
+            projection = self.projections.get(fmt.partition(":")[0], self.fields)
+            shows_collection = self._shows_collection[fmt] = "collection" in projection
+        if shows_collection and self.collection:
+            key += (self.collection.id,)
+        html = fragments.get(key)
+        if html is None:
+            html = fragments.setdefault(key, format(self, fmt))
+        return html
 
     def __str__(self):
         return f"{self}"
 
     def delete(self):
-        cur = conn.cursor()
-        cur.execute("DELETE FROM books WHERE id=?", (self.id,))
-        conn.commit()
+        with db.transaction() as cur:
+            cur.execute("DELETE FROM books WHERE id=?", (self.id,))
         self._cache.pop(self.id)
 
     def rename(self, title):
         self.title = title
-        self.sort_key = self.calculate_sort_key()
         self.save()
 
     def save(self):
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE books
-            SET title=?, authors=?, publisher=?, year=?, imported_at=?, sort_key=?
-            WHERE id = ?
-            """,
-            (
-                self.title,
-                self.authors,
-                self.publisher,
-                self.year,
-                self.imported_at,
-                self.sort_key,
-                self.id,
-            ),
+        # read the fields before taking the write lock, as reading them might
+        # have to populate the book first
+        values = (
+            self.title,
+            self.authors,
+            self.publisher,
+            self.year,
+            self.imported_at,
+            self.id,
         )
-        conn.commit()
+        with db.transaction() as cur:
+            old_authors = cur.execute(
+                "SELECT authors FROM books WHERE id = ?", (self.id,)
+            ).fetchone()["authors"]
+            cur.execute(
+                """
+                UPDATE books
+                SET
+                    title=?,
+                    authors=?,
+                    publisher=?,
+                    year=?,
+                    imported_at=?,
+                    version=version + 1
+                WHERE id = ?
+                """,
+                values,
+            )
+            # the sort key follows the title and authors through triggers.
+            # Relinking runs them for every author, so it's only done when
+            # the authors changed, not on every rename
+            if values[1] != old_authors:
+                db.link_authors(cur, self.id, values[1])
+            row = cur.execute(
+                "SELECT sort_key, version FROM books WHERE id = ?", (self.id,)
+            ).fetchone()
+        self.sort_key = row["sort_key"]
+        self.version = row["version"]
 
     def lend_to(self, borrower):
-        cur = conn.cursor()
-        cur.execute(
-            f"""
-            UPDATE books
-            SET borrowed_to=?
-            WHERE id=?
-            """,
-            (borrower, self.id),
-        )
+        with db.transaction() as cur:
+            cur.execute(
+                f"""
+                UPDATE books
+                SET borrowed_to=?, version=version + 1
+                WHERE id=?
+                """,
+                (borrower, self.id),
+            )
+            self.version = cur.execute(
+                "SELECT version FROM books WHERE id = ?", (self.id,)
+            ).fetchone()["version"]
         self.borrowed_to = borrower
-        conn.commit()
 
     def return_(self):
-        cur = conn.cursor()
-        cur.execute(
-            f"""
-            UPDATE books
-            SET borrowed_to=NULL
-            WHERE id=?
-            """,
-            (self.id,),
-        )
+        with db.transaction() as cur:
+            cur.execute(
+                f"""
+                UPDATE books
+                SET borrowed_to=NULL, version=version + 1
+                WHERE id=?
+                """,
+                (self.id,),
+            )
+            self.version = cur.execute(
+                "SELECT version FROM books WHERE id = ?", (self.id,)
+            ).fetchone()["version"]
         self.borrowed_to = None
-        conn.commit()
 
     @property
     def location(self):
@@ -0,0 +1,138 @@
+"""Make sure none of the queries the app issues scans a whole table.
+
+Builds a throwaway library, runs every model method against it, and looks at
+the EXPLAIN QUERY PLAN of each statement that was executed. Exits with an
+error if any of them contains a full table scan, or if the writer does not
+recover from a transaction that SQLite rolled back by itself. Usage:
+
+    python querycheck.py
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+
+os.environ["OOK_DB"] = os.path.join(tempfile.mkdtemp(), "ook2.db")
+
+import db
+import jobs
+import metadata
+import objects as O
+
+# "SCAN books" is a full scan; "SCAN books USING INDEX ..." walks an index in
+# order (and stops at the LIMIT), and virtual tables bring their own index.
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+def populate():
+    collections = [O.Collection.new(f"Shelf {i}") for i in range(5)]
+    with db.transaction() as cur:
+        for i in range(200):
+            cur.execute(
+                """
+                INSERT INTO books (isbn, title, authors, collection_id, sort_key)
+                VALUES (?, ?, ?, ?, '')
+                """,
+                (
+                    f"978{i:010d}",
+                    f"Book {i}",
+                    f"Author {i % 17}",
+                    collections[i % len(collections)].id,
+                ),
+            )
+            db.link_authors(cur, cur.lastrowid, f"Author {i % 17}")
+    return collections
+
+
+def exercise(collections):
+    O.sync_caches()
+    O.sync_caches()
+    books, _, next_cursor = O.Book.page(size=50)
+    books, prev_cursor, _ = O.Book.page(after=next_cursor, size=50)
+    O.Book.page(before=prev_cursor, size=50)
+    O.Book.page(collection_id=collections[0].id, size=50)
+    O.Book.page(author="Author 3", size=50)
+    _, _, next_cursor = O.Author.page(size=5)
+    O.Author.page(after=next_cursor, size=5)
+    list(O.Book.search("boo auth", page_size=51))
+    list(O.Book.search("boo", collection_id=collections[0].id, page_size=51))
+    list(O.Book.search("", page_size=51))
+    list(O.Collection.all(order_by="name COLLATE NOCASE ASC"))
+
+    book = books[0]
+    O.Book._cache.clear()
+    O.Collection._cache.clear()
+    book = O.Book(book.id)
+    book.title
+    book.collection.name
+    book.lend_to("someone")
+    list(O.Book.all_lent_out())
+    book.return_()
+    book.rename("Another title")
+    book.authors = "Author 1, Author 2"
+    book.save()
+    collections[0].rename("Renamed")
+    book.delete()
+
+    metadata.write_cache("9783161484100", "goob", {"title": "Some title"})
+    metadata.read_cache("9783161484100")
+
+    job_id = jobs.start_import(3, 1)
+    jobs.count_import(job_id, "imported")
+    jobs.get_import(job_id)
+
+    recalculation_id = jobs.start_recalculation()
+    jobs.start_recalculation()
+    jobs.unfinished_recalculations()
+    while O.Book.recalculate_sort_keys(recalculation_id, chunk_size=50):
+        pass
+    jobs.get_recalculation(recalculation_id)
+    jobs.unfinished_recalculations()
+
+
+def check_lost_transaction():
+    # what SQLite does on a full disk or an I/O error
+    try:
+        with db.transaction() as cur:
+            cur.execute("INSERT INTO collections (name) VALUES ('Lost')")
+            db.conn.rollback()
+            raise OSError("disk full")
+    except OSError:
+        pass
+    writer = threading.Thread(target=O.Collection.new, args=("Found",), daemon=True)
+    writer.start()
+    writer.join(5)
+    if writer.is_alive():
+        print("Writes hang after a transaction was rolled back")
+        return 1
+    return 0
+
+
+def main():
+    if check_lost_transaction():
+        return 1
+    collections = populate()
+    statements = []
+    db.set_trace_callback(statements.append)
+    exercise(collections)
+    db.set_trace_callback(None)
+
+    cur = db.conn.cursor()
+    failures = 0
+    for statement in dict.fromkeys(statements):
+        if not statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+            continue
+        plan = [row["detail"] for row in cur.execute(f"EXPLAIN QUERY PLAN {statement}")]
+        scans = [detail for detail in plan if FULL_SCAN.match(detail)]
+        if scans:
+            failures += 1
+            print("Full scan in:", " ".join(statement.split()))
+            for detail in plan:
+                print("   ", detail)
+    print(f"Checked {len(set(statements))} statements, {failures} with full scans")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
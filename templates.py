@@ -0,0 +1,74 @@
+import ast
+import string
+from _string import formatter_field_name_split
+
+
+class Template:
+    """A template in str.format() syntax, compiled once into a function.
+
+    Rendering it costs about as much as the equivalent f-string: the source is
+    parsed a single time, and fields like `{book.title}` or `{book:spine}`
+    become expressions in the compiled code. Rendering takes keyword arguments
+    for the names used in the template and ignores any others.
+    """
+
+    def __init__(self, source, name="template"):
+        self.source = source
+        self.names = []
+        parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                parts.append(ast.Constant(literal))
+            if field is None:
+                continue
+            if "{" in spec:
+                raise ValueError(f"Nested fields aren't supported: {field}:{spec}")
+            parts.append(ast.FormattedValue(
+                value=self._expression(field),
+                conversion=ord(conversion) if conversion else -1,
+                format_spec=ast.JoinedStr([ast.Constant(spec)]) if spec else None,
+            ))
+        function = ast.FunctionDef(
+            name=name,
+            args=ast.arguments(
+                posonlyargs=[],
+                args=[],
+                kwonlyargs=[ast.arg(name) for name in self.names],
+                kw_defaults=[None for _ in self.names],
+                kwarg=ast.arg("_"),
+                defaults=[],
+            ),
+            body=[ast.Return(ast.JoinedStr(parts))],
+            decorator_list=[],
+            returns=None,
+            type_params=[],
+        )
+        module = ast.fix_missing_locations(ast.Module([function], type_ignores=[]))
+        namespace = {}
+        exec(compile(module, f"<template {name}>", "exec"), namespace)
+        self.render = namespace[name]
+
+    def _expression(self, field):
+        first, rest = formatter_field_name_split(field)
+        if not isinstance(first, str) or not first.isidentifier():
+            raise ValueError(f"Fields need to be named: {field!r}")
+        if first not in self.names:
+            self.names.append(first)
+        expression = ast.Name(first, ast.Load())
+        for is_attribute, key in rest:
+            if is_attribute:
+                expression = ast.Attribute(expression, key, ast.Load())
+            else:
+                expression = ast.Subscript(expression, ast.Constant(key), ast.Load())
+        return expression
+
+    def split(self, field):
+        """The parts before and after `{field}`, e.g. to send them separately"""
+        before, _, after = self.source.partition(f"{{{field}}}")
+        return Template(before), Template(after)
+
+    def __call__(self, **values):
+        return self.render(**values)
+
+    def __repr__(self):
+        return f"<Template {self.source[:30]!r}>"